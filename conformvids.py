@@ -1,138 +1,3464 @@
-import os
-import subprocess
-import json
-
-# --------------------
-# Configuration
-# --------------------
-FOLDER_PATH = r"/path/to/your/folder"            # Folder containing .mp4 files
-OUTPUT_DIR  = os.path.join(FOLDER_PATH, "output")  # Where output files go
-
-# --------------------
-# GPU Settings
-# --------------------
-USE_GPU = True               # Set to True to use GPU if available, False to use CPU
-GPU_ENCODER = "h264_nvenc"   # Example for NVIDIA. Could be "hevc_nvenc", "h264_qsv" (Intel), "h264_amf" (AMD), etc.
-
-# --------------------
-# CPU (libx264) Settings
-# --------------------
-VIDEO_CODEC = "libx264"
-CRF_VALUE   = 18       # Lower = higher quality. Typically 18-23 for H.264
-PRESET      = "medium" # ultrafast, superfast, veryfast, faster, fast, medium, slow, etc.
-
-# --------------------
-# Audio Settings
-# --------------------
-AUDIO_CODEC = "copy"   # "copy" keeps original audio. Or use "aac", "ac3", etc.
-
-def main():
-    # 1. Gather all MP4 files
-    mp4_files = [f for f in os.listdir(FOLDER_PATH) if f.lower().endswith(".mp4")]
-    if not mp4_files:
-        print(f"No MP4 files found in {FOLDER_PATH}")
-        return
-
-    # 2. Find the file with the highest resolution
-    max_pixels = 0
-    max_width, max_height = 0, 0
-    max_res_file = None
-
-    for filename in mp4_files:
-        full_path = os.path.join(FOLDER_PATH, filename)
-        w, h = get_video_resolution(full_path)
-        if w * h > max_pixels:
-            max_pixels = w * h
-            max_width, max_height = w, h
-            max_res_file = filename
-
-    if not max_res_file:
-        print("Could not determine a file with the highest resolution.")
-        return
-
-    print(f"Highest resolution: {max_width}x{max_height} ({max_pixels} pixels), from file: {max_res_file}")
-
-    # 3. Create output directory
-    os.makedirs(OUTPUT_DIR, exist_ok=True)
-
-    # 4. Process each file
-    for filename in mp4_files:
-        full_path = os.path.join(FOLDER_PATH, filename)
-        output_path = os.path.join(OUTPUT_DIR, filename)
-
-        w, h = get_video_resolution(full_path)
-
-        # If resolution already matches the highest, do pass-through copy
-        if w == max_width and h == max_height:
-            print(f"File {filename} matches the highest resolution ({w}x{h}). Doing pass-through (copy).")
-            cmd = [
-                "ffmpeg",
-                "-y",
-                "-i", full_path,
-                "-c", "copy",  # Copy video & audio
-                output_path
-            ]
-            subprocess.run(cmd)
-        else:
-            # Otherwise, scale to the highest resolution
-            print(f"Scaling {filename} from {w}x{h} to {max_width}x{max_height} ...")
-
-            # Choose the appropriate video encoder settings
-            if USE_GPU:
-                # GPU-based encoder command
-                video_encoder_args = [
-                    "-c:v", GPU_ENCODER,
-                    # Some GPU encoders support special presets, e.g. "-preset", "p5" for NVENC
-                    # If you want to specify a preset for NVENC, do something like:
-                    # "-preset", "p4",   # or llhq, llhp, etc. (depends on your FFmpeg build)
-                ]
-                # For NVENC, you might also want to set a bitrate or qp. CRF is not always standard for NVENC.
-                # Example: "-b:v", "5M" for 5 Mbps
-            else:
-                # CPU-based encoder command
-                video_encoder_args = [
-                    "-c:v", VIDEO_CODEC,
-                    "-preset", PRESET,
-                    "-crf", str(CRF_VALUE),
-                ]
-
-            cmd = [
-                "ffmpeg",
-                "-y",
-                "-i", full_path,
-                "-vf", f"scale={max_width}:{max_height}"
-            ] + video_encoder_args + [
-                "-c:a", AUDIO_CODEC,
-                output_path
-            ]
-
-            subprocess.run(cmd)
-
-    print("Done! Check the 'output' folder for conformed files.")
-
-def get_video_resolution(file_path):
-    """Return (width, height) of the first video stream using ffprobe JSON."""
-    cmd = [
-        "ffprobe",
-        "-v", "error",
-        "-select_streams", "v:0",
-        "-show_entries", "stream=width,height",
-        "-of", "json",
-        file_path
-    ]
-    result = subprocess.run(cmd, capture_output=True, text=True)
-    if result.returncode != 0:
-        print(f"FFprobe error on {file_path}: {result.stderr}")
-        return (0, 0)
-
-    try:
-        data = json.loads(result.stdout)
-        width = data["streams"][0]["width"]
-        height = data["streams"][0]["height"]
-        return (int(width), int(height))
-    except Exception as e:
-        print(f"Error parsing resolution for {file_path}: {e}")
-        return (0, 0)
-
-if __name__ == "__main__":
-    main()
+import os
+import subprocess
+import json
+import math
+import struct
+import sqlite3
+import sys
+import argparse
+import time
+import threading
+import shutil
+import errno
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from collections import deque
+from contextlib import contextmanager, redirect_stdout
+import platform
+import statistics
+import re
+import tempfile
+import heapq
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from dataclasses import dataclass, field, asdict
+
+# --------------------
+# Configuration
+# --------------------
+FOLDER_PATH = r"/path/to/your/folder"            # Folder containing .mp4 files
+OUTPUT_DIR  = os.path.join(FOLDER_PATH, "output")  # Where output files go
+
+# --------------------
+# GPU Settings
+# --------------------
+USE_GPU = True               # Set to True to use GPU if available, False to use CPU
+GPU_ENCODER = "h264_nvenc"   # Example for NVIDIA. Could be "hevc_nvenc", "h264_qsv" (Intel), "h264_amf" (AMD), etc. (see ENCODERS)
+CHECK_ENCODER = True         # Validate the encoder against the local ffmpeg build first; fall back to VIDEO_CODEC if the GPU one is unusable
+
+# --------------------
+# CPU Encoder Settings
+# --------------------
+VIDEO_CODEC = "libx264"  # "libx264", "libx265", "libsvtav1" or "libvpx-vp9" (see ENCODERS)
+CRF_VALUE   = 18       # Lower = higher quality. Typically 18-23 for H.264, 20-28 for H.265, 25-35 for AV1/VP9
+PRESET      = "medium" # ultrafast, superfast, veryfast, faster, fast, medium, slow, etc. (mapped for AV1/VP9)
+
+# --------------------
+# Calibration Settings (see the "calibrate" command)
+# --------------------
+USE_CALIBRATION   = False   # Replace PRESET/CRF_VALUE with the fastest calibrated setting meeting the quality bar
+QUALITY_METRIC    = "ssim"  # "ssim" (0-1) or "psnr" (dB)
+QUALITY_THRESHOLD = 0.985   # Minimum QUALITY_METRIC a calibrated setting must reach
+CALIBRATE_PRESETS = ["ultrafast", "superfast", "veryfast", "faster", "fast", "medium", "slow"]
+CALIBRATE_CRFS    = [18, 20, 23]
+CALIBRATE_SAMPLES = 3       # Representative input files to sample
+CALIBRATE_SECONDS = 5       # Length of the sample taken from the middle of each file
+CALIBRATION_PATH  = None    # None = $XDG_CACHE_HOME/conformvids/calibration.json
+
+# --------------------
+# Audio Settings
+# --------------------
+AUDIO_CODEC = "copy"   # "copy" keeps original audio. Or use "aac", "ac3", etc.
+
+# --------------------
+# Pass-through Settings
+# --------------------
+# How files that already match the target are copied. "auto" tries the cheapest first:
+# hardlink (no data written), reflink (copy-on-write clone, btrfs/XFS), kernel-side copy
+# (copy_file_range/sendfile), and finally an ffmpeg remux ("-c copy"), which was the old behaviour.
+PASSTHROUGH_STRATEGY = "auto"   # "auto", "hardlink", "reflink", "copy" or "remux"
+
+# --------------------
+# Parallelism Settings
+# --------------------
+MAX_JOBS        = None  # Concurrent ffmpeg jobs. None = derive from CPU count
+THREADS_PER_JOB = None  # ffmpeg "-threads" per job. None = split the CPUs evenly across jobs
+CPUS_PER_JOB    = None  # Used to derive MAX_JOBS. None = the encoder backend's own figure (4 for x264, 16 for SVT-AV1, ...)
+MEMORY_PER_JOB_MB = 1024  # Used to derive MAX_JOBS under a memory limit (cgroup or physical RAM)
+LONGEST_FIRST   = True  # Start the jobs with the largest estimated cost first, so no big file starts last
+ADAPTIVE_CONCURRENCY = False  # Grow/shrink the number of running jobs from measured throughput (also --adaptive)
+ADAPT_INTERVAL       = 15     # Seconds of throughput measured before each adaptive decision
+ADAPT_MAX_JOBS       = None   # Upper bound for the adaptive controller. None = one job per CPU
+MEMORY_BUDGET_MB  = None  # Only start a job while estimated peak RSS of running jobs fits. None = 85% of the limit
+MEMORY_MODEL_PATH = None  # Memory estimates learned from measured RSS. None = $XDG_CACHE_HOME/conformvids/memory_model.json
+PROBE_WORKERS   = 16    # Concurrent ffprobe calls during discovery (I/O bound, so can exceed CPUs)
+PROBE_ENGINE    = "auto"  # "auto" = read MP4/MOV headers in-process, ffprobe only as fallback; "ffprobe" = always spawn ffprobe
+
+# --------------------
+# Probe Cache Settings
+# --------------------
+USE_PROBE_CACHE  = True  # Reuse ffprobe results for files that have not changed since the last run
+PROBE_CACHE_PATH = None  # None = $XDG_CACHE_HOME/conformvids/probe_cache.sqlite (or ~/.cache/...)
+
+# --------------------
+# History Settings
+# --------------------
+USE_HISTORY    = True  # Record every finished job and predict job durations from them (see the "plan" command)
+HISTORY_PATH   = None  # None = $XDG_CACHE_HOME/conformvids/history.sqlite
+HISTORY_WINDOW = 200   # Most recent matching jobs a prediction is based on
+
+# --------------------
+# Incremental Settings
+# --------------------
+INCREMENTAL   = True                     # Skip outputs already produced from the same input with the same settings
+MANIFEST_NAME = ".conform_manifest.json"  # Stored in OUTPUT_DIR
+JOURNAL_NAME  = ".conform_journal.sqlite" # Per-file job states, stored in OUTPUT_DIR; used by --resume
+REPORT_NAME   = ".conform_report.json"   # Per-job resolution, timing and CPU/memory usage of the last run
+
+# --------------------
+# Segmented Encoding Settings
+# --------------------
+SEGMENT_ENCODING     = True  # Split long inputs at keyframes and encode the pieces in parallel
+SEGMENT_MIN_DURATION = 600   # Only inputs at least this long (seconds) are split
+SEGMENT_SECONDS      = 120   # Target segment length; cuts land on the next keyframe
+
+# --------------------
+# Progress Settings
+# --------------------
+PROGRESS_INTERVAL = 10  # Seconds between batch progress lines while encoding. 0 = off
+
+# --------------------
+# Metrics Settings
+# --------------------
+METRICS_TEXTFILE = None  # Prometheus text file to write, e.g. for node_exporter's textfile collector
+METRICS_PORT     = None  # Serve http://localhost:PORT/metrics while running. None = off
+TRACE_PATH       = None  # Write a Chrome trace-event JSON of the run here (open in Perfetto). None = off
+
+
+@dataclass
+class Job:
+    """One ffmpeg invocation in the conform loop."""
+    filename: str
+    kind: str              # "copy", "scale", or "split"/"segment"/"concat" for segmented encodes
+    cmd: list
+    action: object = None   # action(job, progress) -> returncode; run in-process instead of cmd when set
+    output_path: str = None
+    partial_path: str = None  # ffmpeg writes here; renamed to output_path once complete
+    signature: dict = None  # What the output depends on; see job_signature()
+    work_dir: str = None      # Created before the job runs (segment scratch space)
+    followups: object = None  # followups(job) -> list of Jobs to run next, called once the job ends
+    returncode: int = None
+    elapsed: float = 0.0
+    extra: dict = field(default_factory=dict)
+
+    @property
+    def label(self):
+        part = self.extra.get("part")
+        return f"{self.filename} (part {part[0]}/{part[1]})" if part else self.filename
+
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+PROC_CGROUP = "/proc/self/cgroup"
+
+
+def read_cgroup_value(directory, name):
+    """First line of a cgroup control file, or None if it does not exist."""
+    try:
+        with open(os.path.join(directory, name)) as f:
+            return f.readline().strip()
+    except OSError:
+        return None
+
+
+def parse_cpu_list(text):
+    """Count the CPUs in a cpuset list such as "0-3,8,10-11"."""
+    count = 0
+    for part in filter(None, text.split(",")):
+        first, _, last = part.partition("-")
+        count += int(last or first) - int(first) + 1
+    return count
+
+
+def cgroup_dirs():
+    """(version, directory) for each cgroup this process is in, innermost directory first.
+
+    /proc/self/cgroup gives the path within each hierarchy. Inside a container with
+    its own cgroup namespace that path is "/" and the mount is already the container's
+    cgroup; without one the path may not be visible, and the mount root is used. The
+    same goes for paths relative to the namespace root, such as "/../../x".
+    """
+    try:
+        with open(PROC_CGROUP) as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return []
+    if os.path.exists(os.path.join(CGROUP_ROOT, "cgroup.controllers")):
+        unified = CGROUP_ROOT
+    else:
+        unified = os.path.join(CGROUP_ROOT, "unified")  # Hybrid hosts mount v2 beside v1
+    found = []
+    for line in lines:
+        _, controllers, path = line.split(":", 2)
+        if controllers.startswith("name="):
+            continue
+        version, root = (2, unified) if not controllers else (1, os.path.join(CGROUP_ROOT, controllers))
+        root = os.path.normpath(root)
+        directory = os.path.normpath(os.path.join(root, path.lstrip("/")))
+        if os.path.commonpath([directory, root]) != root or not os.path.isdir(directory):
+            directory = root
+        # Limits apply along the whole hierarchy, so parents are checked too
+        while True:
+            found.append((version, directory))
+            parent = os.path.dirname(directory)
+            if directory == root or parent == directory:
+                break
+            directory = parent
+    return found
+
+
+def cgroup_limits():
+    """CPU quota (in CPUs), cpuset size and memory limit (bytes) set by cgroups v1 or v2.
+
+    Each value is None when there is no limit. The tightest limit along the hierarchy wins.
+    """
+    quota = cpuset = memory = None
+    versions = set()
+
+    def tighter(current, value):
+        return value if current is None else min(current, value)
+
+    for version, directory in cgroup_dirs():
+        cpu_limit = mem_limit = None
+        if version == 2:
+            cpu_max = read_cgroup_value(directory, "cpu.max")            # "max 100000" or "400000 100000"
+            if cpu_max and not cpu_max.startswith("max"):
+                limit, period = cpu_max.split()
+                cpu_limit = int(limit) / int(period)
+            mem_max = read_cgroup_value(directory, "memory.max")
+            if mem_max and mem_max != "max":
+                mem_limit = int(mem_max)
+            cpus = read_cgroup_value(directory, "cpuset.cpus.effective")
+        else:
+            limit = read_cgroup_value(directory, "cpu.cfs_quota_us")      # -1 = no quota
+            period = read_cgroup_value(directory, "cpu.cfs_period_us")
+            if limit and period and int(limit) > 0:
+                cpu_limit = int(limit) / int(period)
+            mem_max = read_cgroup_value(directory, "memory.limit_in_bytes")
+            if mem_max and int(mem_max) < 1 << 62:                       # "No limit" is a huge page-rounded number
+                mem_limit = int(mem_max)
+            cpus = read_cgroup_value(directory, "cpuset.effective_cpus")
+        if cpu_limit:
+            quota = tighter(quota, cpu_limit)
+            versions.add(version)
+        if mem_limit:
+            memory = tighter(memory, mem_limit)
+            versions.add(version)
+        if cpus:
+            cpuset = tighter(cpuset, parse_cpu_list(cpus))
+    return {"cpu_quota": quota, "cpuset": cpuset, "memory": memory, "version": max(versions, default=None)}
+
+
+def effective_resources():
+    """CPUs and memory this process can actually use: affinity, cgroup quota, cpuset and memory limit."""
+    online = os.cpu_count() or 1
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = online
+    limits = cgroup_limits()
+    if limits["cpuset"]:
+        cpus = min(cpus, limits["cpuset"])
+    if limits["cpu_quota"]:
+        # A quota of 2.5 CPUs throttles 3 busy threads every period; round down
+        cpus = min(cpus, max(1, int(limits["cpu_quota"])))
+    try:
+        memory = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (AttributeError, ValueError, OSError):
+        memory = None  # No sysconf on Windows; size by CPUs (and any cgroup limit) alone
+    if limits["memory"]:
+        memory = min(memory or limits["memory"], limits["memory"])
+    return dict(limits, online_cpus=online, cpus=cpus, total_memory=memory)
+
+
+def describe_resources(resources):
+    """One line on where the CPU and memory figures used for sizing came from."""
+    cpu_notes = [f"{resources['online_cpus']} online"]
+    if resources["cpuset"]:
+        cpu_notes.append(f"cpuset {resources['cpuset']}")
+    if resources["cpu_quota"]:
+        cpu_notes.append(f"cgroup v{resources['version']} quota {resources['cpu_quota']:g}")
+    if not resources["total_memory"]:
+        return f"{resources['cpus']} CPU(s) ({', '.join(cpu_notes)}), memory size unknown"
+    memory_note = f"cgroup v{resources['version']} limit" if resources["memory"] else "physical"
+    return (f"{resources['cpus']} CPU(s) ({', '.join(cpu_notes)}), "
+            f"{resources['total_memory'] / (1 << 30):.1f} GB memory ({memory_note})")
+
+
+def available_cpus():
+    """Number of CPUs this process may keep busy, after affinity and cgroup limits."""
+    return effective_resources()["cpus"]
+
+
+def plan_concurrency(max_jobs=None, threads_per_job=None, cpus=None, backend=None, memory=None):
+    """Return (jobs, threads) so that jobs * threads does not exceed the CPU count.
+
+    Without an explicit max_jobs the job count follows the encoder backend: one process
+    per cpus_per_job cores, capped at the sessions a hardware encoder allows and at
+    MEMORY_PER_JOB_MB per job within memory (bytes), when given.
+    """
+    if cpus is None:
+        resources = effective_resources()
+        cpus, memory = resources["cpus"], memory or resources["total_memory"]
+    backend = backend or active_encoder()
+    if max_jobs is None:
+        max_jobs = max(1, cpus // (CPUS_PER_JOB or backend.cpus_per_job))
+        if backend.max_sessions:
+            max_jobs = min(max_jobs, backend.max_sessions)
+        if memory:
+            max_jobs = min(max_jobs, max(1, memory // (MEMORY_PER_JOB_MB << 20)))
+    max_jobs = max(1, int(max_jobs))
+    if threads_per_job is None:
+        threads_per_job = max(1, cpus // max_jobs)
+    return max_jobs, max(1, int(threads_per_job))
+
+
+def segment_work_dir(output_path):
+    """Scratch directory for a segmented encode, e.g. "output/.clip.segments"."""
+    folder, name = os.path.split(output_path)
+    return os.path.join(folder, f".{os.path.splitext(name)[0]}.segments")
+
+
+def partial_path_for(output_path):
+    """Temporary name an output is written under, e.g. "output/.clip.part.mp4"."""
+    folder, name = os.path.split(output_path)
+    stem, ext = os.path.splitext(name)
+    return os.path.join(folder, f".{stem}.part{ext}")
+
+
+def is_partial_name(name):
+    return name.startswith(".") and (".part." in name or name.endswith(".segments"))
+
+
+def finalize_output(job):
+    """Flush the finished partial file to disk and atomically move it into place."""
+    if not job.partial_path or job.partial_path == job.output_path:
+        return
+    with tracer.span("fsync+rename", "io", file=job.filename):
+        fd = os.open(job.partial_path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        if os.path.exists(job.output_path) and os.path.samefile(job.partial_path, job.output_path):
+            # A re-run hardlinks the same input again; rename() between two links to one
+            # inode succeeds without doing anything, which would leave the partial behind
+            os.remove(job.partial_path)
+        else:
+            os.replace(job.partial_path, job.output_path)
+
+
+def discard_partial(job):
+    if job.partial_path and job.partial_path != job.output_path:
+        try:
+            os.remove(job.partial_path)
+        except FileNotFoundError:
+            pass
+
+
+def parse_progress(block):
+    """Turn one block of ffmpeg -progress key=value pairs into numbers."""
+    def number(key, cast=float):
+        try:
+            return cast(block.get(key, "").rstrip("x"))
+        except ValueError:
+            return cast(0)
+
+    return {
+        "frame": number("frame", int),
+        "fps": number("fps"),
+        "out_time": number("out_time_us", int) / 1e6,  # out_time_ms is also microseconds
+        "speed": number("speed"),
+        "total_size": number("total_size", int),
+        "done": block.get("progress") == "end",
+    }
+
+
+class BatchProgress:
+    """Live per-job progress from ffmpeg's -progress stream, aggregated over a batch.
+
+    The scheduler and metrics exporters read snapshot(); ffmpeg workers call update().
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        self.running = {}       # id(job) -> latest parse_progress() dict
+        self.media_total = 0.0  # Seconds of media queued so far
+        self.media_done = 0.0   # Seconds of media in finished jobs
+        self.frames_done = 0
+        self.pixel_frames_done = 0  # Frames x target pixels in finished jobs
+
+    def add(self, job):
+        with self.lock:
+            self.media_total += job.extra.get("duration", 0.0)
+
+    def update(self, job, progress):
+        progress["duration"] = job.extra.get("duration") or progress["out_time"]
+        progress["pixels"] = job.extra.get("target_pixels", 0)
+        with self.lock:
+            self.running[id(job)] = progress
+
+    def finish(self, job):
+        with self.lock:
+            last = self.running.pop(id(job), None)
+            if last:
+                self.frames_done += last["frame"]
+                self.pixel_frames_done += last["frame"] * last["pixels"]
+                job.extra["frames"] = last["frame"]
+            self.media_done += job.extra.get("duration", 0.0)
+
+    def snapshot(self):
+        """Aggregate view: running jobs, frames/s, realtime factor, completion and ETA."""
+        with self.lock:
+            active = list(self.running.values())
+            in_flight = sum(min(p["out_time"], p["duration"]) for p in active)
+            done = self.media_done + in_flight
+            elapsed = time.perf_counter() - self.start
+            snap = {
+                "running": len(active),
+                "fps": sum(p["fps"] for p in active),
+                "speed": sum(p["speed"] for p in active),
+                "frames": self.frames_done + sum(p["frame"] for p in active),
+                "pixel_frames": self.pixel_frames_done + sum(p["frame"] * p["pixels"] for p in active),
+                "media_done": done,
+                "media_total": self.media_total,
+                "elapsed": elapsed,
+            }
+        rate = done / elapsed if elapsed > 0 else 0.0
+        remaining = max(snap["media_total"] - done, 0.0)
+        snap["fraction"] = done / snap["media_total"] if snap["media_total"] else 0.0
+        snap["eta"] = remaining / rate if rate > 0 else None
+        return snap
+
+    def describe(self):
+        snap = self.snapshot()
+        if snap["eta"] is None:
+            eta = "unknown"
+        elif snap["eta"] < 120:
+            eta = f"{snap['eta']:.0f}s"
+        else:
+            eta = f"{snap['eta'] / 60:.1f} min"
+        return (f"{snap['running']} running, {snap['fps']:.0f} fps, {snap['speed']:.1f}x realtime, "
+                f"{snap['fraction'] * 100:.0f}% of media done, ETA {eta}")
+
+
+def run_ffmpeg(job, progress=None):
+    """Run job.cmd with -progress on stdout, streaming updates into progress. Returns the exit code."""
+    cmd = [job.cmd[0], "-progress", "pipe:1"] + job.cmd[1:]
+    proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, text=True)
+    block = {}
+    for line in proc.stdout:
+        key, _, value = line.strip().partition("=")
+        block[key] = value
+        if key == "progress":
+            if progress:
+                progress.update(job, parse_progress(block))
+            block = {}
+    proc.stdout.close()
+    if not hasattr(os, "wait4"):
+        return proc.wait()
+    # Reap the child ourselves so its resource usage is not lost
+    _, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    job.extra["rusage"] = {
+        "user": usage.ru_utime,
+        "sys": usage.ru_stime,
+        "max_rss_kb": usage.ru_maxrss,
+        "in_blocks": usage.ru_inblock,
+        "out_blocks": usage.ru_oublock,
+    }
+    return proc.returncode
+
+
+def run_job(job, on_start=None, progress=None):
+    """Run a single ffmpeg job, recording its return code and wall time.
+
+    An exception while running the job or moving its output into place fails this job
+    (returncode -1) instead of escaping into run_jobs and ending the batch.
+    """
+    start = time.perf_counter()
+    try:
+        if on_start:
+            on_start(job)
+        if job.work_dir:
+            os.makedirs(job.work_dir, exist_ok=True)
+        start = time.perf_counter()
+        with tracer.span(job.kind, "job", file=job.filename, part=job.extra.get("part")):
+            if job.action:
+                job.returncode = job.action(job, progress)
+            else:
+                job.returncode = run_ffmpeg(job, progress)
+        if job.returncode == 0:
+            finalize_output(job)
+        else:
+            discard_partial(job)
+    except Exception as e:
+        print(f"[{job.kind}] {job.label}: {type(e).__name__}: {e}")
+        job.returncode = -1
+        try:
+            discard_partial(job)
+        except OSError:
+            pass
+    if progress:
+        progress.finish(job)
+    job.elapsed = time.perf_counter() - start
+    return job
+
+
+class MemoryModel:
+    """Admits jobs only while their estimated peak RSS fits in a memory budget.
+
+    An encode is estimated at a fixed base plus the backend's memory_per_pixel for each
+    target pixel and a few decoded frames of input. Each (kind, encoder) pair keeps a
+    correction factor learned from measured max RSS and saved to path for later runs;
+    it rises at once when a job uses more than predicted and decays slowly otherwise.
+    """
+
+    BASE = 64 << 20          # ffmpeg, demuxer and muxer buffers
+    INPUT_BYTES_PER_PIXEL = 24  # Decoded input frames queued ahead of the scaler
+
+    def __init__(self, budget, path=None):
+        self.budget = budget
+        self.path = path
+        self.in_use = 0
+        self.peak = 0
+        self.delays = {}  # label -> seconds waited
+        self.waiting_since = {}
+        self.lock = threading.Lock()
+        self.factors = {}
+        if path:
+            try:
+                with open(path) as f:
+                    self.factors = json.load(f)
+            except (OSError, ValueError):
+                pass
+
+    @staticmethod
+    def key(job):
+        return f"{job.kind}:{job.extra.get('encoder') or ''}"
+
+    def base_estimate(self, job):
+        if job.kind not in ("scale", "segment"):
+            return self.BASE
+        w, h = job.extra.get("input_resolution") or (0, 0)
+        return (self.BASE + active_encoder().memory_per_pixel * job.extra.get("target_pixels", 0)
+                + self.INPUT_BYTES_PER_PIXEL * w * h)
+
+    def estimate(self, job):
+        return int(self.base_estimate(job) * self.factors.get(self.key(job), 1.0))
+
+    def admit(self, job, running):
+        """Reserve memory for job and return True, or return False if it has to wait.
+
+        A job is always admitted when nothing else is running, so one that is larger
+        than the whole budget still runs, on its own. A budget of None admits every job.
+        """
+        need = self.estimate(job)
+        with self.lock:
+            if running and self.budget is not None and self.in_use + need > self.budget:
+                if job.label not in self.waiting_since:
+                    self.waiting_since[job.label] = time.monotonic()
+                    print(f"[memory] Holding {job.label} (~{need / (1 << 20):.0f} MB) until memory frees up: "
+                          f"~{self.in_use / (1 << 20):.0f} of {self.budget / (1 << 20):.0f} MB in use")
+                return False
+            since = self.waiting_since.pop(job.label, None)
+            if since is not None:
+                self.delays[job.label] = time.monotonic() - since
+                job.extra["memory_wait"] = self.delays[job.label]
+            job.extra["memory_estimate"] = need
+            self.in_use += need
+            self.peak = max(self.peak, self.in_use)
+            return True
+
+    def release(self, job):
+        """Return job's reservation and learn from its measured peak RSS."""
+        with self.lock:
+            self.in_use -= job.extra.get("memory_estimate", 0)
+            rss = job.extra.get("rusage", {}).get("max_rss_kb")
+            if not rss or job.returncode != 0:
+                return
+            ratio = rss * 1024 / self.base_estimate(job)
+            key = self.key(job)
+            old = self.factors.get(key)
+            # Over-estimates only cost parallelism; under-estimates risk the OOM killer
+            self.factors[key] = ratio if old is None or ratio > old else 0.8 * old + 0.2 * ratio
+
+    def summary(self):
+        if not self.delays:
+            return None
+        return (f"{len(self.delays)} job(s) waited {sum(self.delays.values()):.1f}s for memory "
+                f"(budget {self.budget / (1 << 20):.0f} MB, peak estimated {self.peak / (1 << 20):.0f} MB)")
+
+    def save(self):
+        if not self.path:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path + ".tmp", "w") as f:
+            json.dump(self.factors, f, indent=1, sort_keys=True)
+        os.replace(self.path + ".tmp", self.path)
+
+
+def read_cpu_times():
+    """(busy, iowait, total) jiffies summed over all CPUs from /proc/stat, or None."""
+    try:
+        with open("/proc/stat") as f:
+            fields = [int(v) for v in f.readline().split()[1:9]]
+    except (OSError, ValueError):
+        return None
+    idle, iowait, total = fields[3], fields[4], sum(fields)
+    return total - idle - iowait, iowait, total
+
+
+class ConcurrencyController:
+    """AIMD control of how many jobs run at once, driven by measured throughput.
+
+    Every interval it measures the batch's throughput in pixels per second (frames
+    weighted by target resolution, so a mix of sizes compares fairly) and the host's
+    CPU busy and I/O wait shares. It adds one job while CPUs are idle and the last
+    added job paid off, and cuts the limit by a quarter when I/O wait is high or
+    throughput did not improve after growing. Running jobs are never stopped; a lower
+    limit takes effect as they finish.
+    """
+
+    GROW_BELOW_BUSY = 0.90  # Add a job only while the CPUs are less busy than this
+    IOWAIT_LIMIT = 0.20     # Back off when this share of CPU time waits on I/O
+    MIN_GAIN = 0.03         # An added job must raise throughput by this much to stay
+    BACKOFF = 0.75
+
+    def __init__(self, limit, max_limit, interval):
+        self.limit = limit
+        self.max_limit = max(limit, max_limit)
+        self.interval = interval
+        self.next_check = None
+        self.last_sample = None
+        self.last_rate = None
+        self.last_change = 0
+        self.low = self.high = limit
+
+    def update(self, progress, backlog):
+        """Return the job limit to use now; backlog is False once nothing is left to start."""
+        now = time.monotonic()
+        if self.next_check is not None and now < self.next_check:
+            return self.limit
+        self.next_check = now + self.interval
+        cpu = read_cpu_times()
+        sample = (progress.snapshot()["pixel_frames"], cpu, now)
+        previous, self.last_sample = self.last_sample, sample
+        if previous is None:
+            return self.limit
+        rate = (sample[0] - previous[0]) / (now - previous[2])
+        last_rate, self.last_rate = self.last_rate, rate
+        busy = iowait = None
+        if cpu and previous[1]:
+            total = (cpu[2] - previous[1][2]) or 1
+            busy = (cpu[0] - previous[1][0]) / total
+            iowait = (cpu[1] - previous[1][1]) / total
+        if not backlog or not rate:
+            self.last_change = 0  # Nothing left to start, or only copies running: nothing to learn
+            return self.limit
+
+        new = self.limit
+        if iowait is not None and iowait > self.IOWAIT_LIMIT:
+            new, reason = max(1, min(self.limit - 1, int(self.limit * self.BACKOFF))), f"I/O wait {iowait:.0%}"
+        elif self.last_change > 0 and last_rate and rate < last_rate * (1 + self.MIN_GAIN):
+            new = max(1, min(self.limit - 1, int(self.limit * self.BACKOFF)))
+            reason = f"no gain from the last job added (was {last_rate / 1e6:.1f} Mpx/s)"
+        elif busy is not None and busy < self.GROW_BELOW_BUSY and self.limit < self.max_limit:
+            new, reason = self.limit + 1, f"CPU {busy:.0%} busy"
+        if new == self.limit:
+            self.last_change = 0
+            return self.limit
+        print(f"[adaptive] {self.limit} -> {new} job(s) at {rate / 1e6:.1f} Mpx/s: {reason}")
+        self.last_change = new - self.limit
+        self.limit = new
+        self.low, self.high = min(self.low, new), max(self.high, new)
+        return self.limit
+
+
+def run_jobs(jobs, max_jobs, on_done=None, on_start=None, progress=None, memory=None, controller=None):
+    """Run jobs on a pool of max_jobs workers. Returns (jobs, wall-clock seconds).
+
+    on_start(job) is called from the worker thread just before ffmpeg is launched;
+    on_done(job) is called from the calling thread as each job finishes. Jobs returned
+    by a job's followups are run next, ahead of the rest of the queue. Live progress is
+    collected in progress (a BatchProgress) and printed every PROGRESS_INTERVAL seconds.
+    With a MemoryModel, the next job in the queue waits until its memory estimate fits.
+    With a ConcurrencyController, it sets the number of running jobs instead of max_jobs.
+    """
+    start = time.perf_counter()
+    progress = progress or BatchProgress()
+    metrics.progress = progress
+    pending = deque(jobs)
+    for job in jobs:
+        progress.add(job)
+    running = set()
+    finished = []
+    next_report = time.monotonic() + PROGRESS_INTERVAL
+    limit = max_jobs
+    workers = controller.max_limit if controller else max_jobs
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="job") as pool:
+        while pending or running:
+            if controller:
+                limit = controller.update(progress, bool(pending))
+            while pending and len(running) < limit:
+                if memory and not memory.admit(pending[0], len(running)):
+                    break
+                running.add(pool.submit(run_job, pending.popleft(), on_start, progress))
+            deadlines = [next_report] if PROGRESS_INTERVAL else []
+            if controller:
+                deadlines.append(controller.next_check)
+            timeout = max(min(deadlines) - time.monotonic(), 0) if deadlines else None
+            done, running = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+            if PROGRESS_INTERVAL and time.monotonic() >= next_report:
+                print(f"[progress] {progress.describe()}")
+                next_report = time.monotonic() + PROGRESS_INTERVAL
+            for future in done:
+                job = future.result()
+                finished.append(job)
+                if memory:
+                    memory.release(job)
+                status = "ok" if job.returncode == 0 else f"FAILED (exit {job.returncode})"
+                strategy = job.extra.get("strategy")
+                kind = f"{job.kind}/{strategy}" if strategy else job.kind
+                print(f"[{kind}] {job.label}: {status} in {job.elapsed:.1f}s")
+                record_job_metrics(job)
+                if on_done:
+                    on_done(job)
+                if job.followups:
+                    followups = job.followups(job)
+                    for followup in followups:
+                        progress.add(followup)
+                    pending.extendleft(reversed(followups))
+    return finished, time.perf_counter() - start
+
+
+def encoder_settings():
+    """The settings a re-encoded output depends on."""
+    return {
+        "USE_GPU": USE_GPU,
+        "GPU_ENCODER": GPU_ENCODER,
+        "VIDEO_CODEC": VIDEO_CODEC,
+        "CRF_VALUE": CRF_VALUE,
+        "PRESET": PRESET,
+        "AUDIO_CODEC": AUDIO_CODEC,
+    }
+
+
+def job_signature(full_path, kind, target):
+    """Describe everything an output depends on: input fingerprint, target and settings."""
+    _, size, mtime_ns, inode = file_fingerprint(full_path)
+    return {
+        "input": {"size": size, "mtime_ns": mtime_ns, "inode": inode},
+        "target": list(target),
+        "kind": kind,
+        # Pass-through copies are bit-identical whatever the encoder settings are
+        "settings": encoder_settings() if kind == "scale" else {},
+    }
+
+
+def load_manifest(output_dir):
+    """Return {output filename: {"signature": ..., "output_size": ...}} from the last runs."""
+    try:
+        with open(os.path.join(output_dir, MANIFEST_NAME)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_manifest(output_dir, manifest):
+    """Write the manifest atomically so an interrupted save never corrupts it."""
+    path = os.path.join(output_dir, MANIFEST_NAME)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def is_up_to_date(manifest, job):
+    """True if job's output exists and was produced from the same signature."""
+    entry = manifest.get(job.filename)
+    if not entry or entry.get("signature") != job.signature:
+        return False
+    try:
+        return os.path.getsize(job.output_path) == entry.get("output_size")
+    except OSError:
+        return False
+
+
+class Journal:
+    """Durable per-file job states (pending, running, done, failed) in a SQLite WAL database."""
+
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.path = os.path.join(output_dir, JOURNAL_NAME)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=FULL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " filename TEXT PRIMARY KEY, state TEXT, signature TEXT, output_path TEXT,"
+            " partial_path TEXT, output_size INTEGER, returncode INTEGER, updated REAL)"
+        )
+
+    def reset(self):
+        with self.lock:
+            self.db.execute("DELETE FROM jobs")
+
+    def is_done(self, job):
+        """True if job completed in an earlier run with the same signature and its output is intact."""
+        with self.lock:
+            row = self.db.execute(
+                "SELECT signature, output_size FROM jobs WHERE filename = ? AND state = 'done'",
+                (job.filename,),
+            ).fetchone()
+        if row is None or json.loads(row[0]) != job.signature:
+            return False
+        try:
+            return os.path.getsize(job.output_path) == row[1]
+        except OSError:
+            return False
+
+    def cleanup_partials(self):
+        """Delete half-written outputs left by an interrupted run. Returns the number removed."""
+        with self.lock:
+            paths = {p for (p,) in self.db.execute(
+                "SELECT partial_path FROM jobs WHERE state != 'done' AND partial_path IS NOT NULL"
+            )}
+        paths.update(os.path.join(self.output_dir, name)
+                     for name in os.listdir(self.output_dir) if is_partial_name(name))
+        removed = 0
+        for path in paths:
+            try:
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+                removed += 1
+            except FileNotFoundError:
+                pass
+        return removed
+
+    def add_pending(self, jobs):
+        with self.lock:
+            self.db.execute("BEGIN")
+            self.db.executemany(
+                "INSERT OR REPLACE INTO jobs (filename, state, signature, output_path, partial_path, updated)"
+                " VALUES (?, 'pending', ?, ?, ?, ?)",
+                [(job.filename, json.dumps(job.signature, sort_keys=True), job.output_path,
+                  job.partial_path, time.time()) for job in jobs],
+            )
+            self.db.execute("COMMIT")
+
+    def mark_running(self, job):
+        with self.lock:
+            self.db.execute(
+                "UPDATE jobs SET state = 'running', updated = ? WHERE filename = ?",
+                (time.time(), job.filename),
+            )
+
+    def mark_finished(self, job):
+        state = "done" if job.returncode == 0 else "failed"
+        size = os.path.getsize(job.output_path) if state == "done" else None
+        with self.lock:
+            self.db.execute(
+                "UPDATE jobs SET state = ?, output_size = ?, returncode = ?, updated = ? WHERE filename = ?",
+                (state, size, job.returncode, time.time(), job.filename),
+            )
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+FICLONE = 0x40049409  # linux/fs.h: _IOW(0x94, 9, int)
+PASSTHROUGH_ORDER = ("hardlink", "reflink", "copy", "remux")
+_unsupported = set()  # (strategy, source device, destination device) combinations that failed
+
+
+def hardlink_file(src, dst):
+    os.link(src, dst)
+    return 0
+
+
+def reflink_file(src, dst):
+    try:
+        import fcntl
+    except ImportError:  # Windows: no FICLONE either way, so let passthrough() try the next strategy
+        raise OSError(errno.EOPNOTSUPP, "reflinks need fcntl, which this platform lacks")
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    return 0
+
+
+def kernel_copy_file(src, dst):
+    """Copy src to dst inside the kernel with copy_file_range, or sendfile where that is missing.
+
+    Raises OSError if neither is available or the copy ends short of the source size.
+    """
+    copied = 0
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        size = os.fstat(fsrc.fileno()).st_size
+        copy = getattr(os, "copy_file_range", None)
+        while copied < size:
+            if not copy and not hasattr(os, "sendfile"):
+                raise OSError(errno.EOPNOTSUPP, "no copy_file_range or sendfile on this platform")
+            try:
+                n = copy(fsrc.fileno(), fdst.fileno(), size - copied) if copy else \
+                    os.sendfile(fdst.fileno(), fsrc.fileno(), copied, size - copied)
+            except OSError as e:
+                if copy and e.errno in (errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL):
+                    copy = None  # e.g. cross-filesystem on older kernels; continue with sendfile
+                    fsrc.seek(copied)
+                    continue
+                raise
+            if n == 0:
+                break
+            copied += n
+    if copied < size:
+        # The source shrank or the kernel stopped early; never pass a truncated file off as done
+        raise OSError(errno.EIO, f"short copy: {copied} of {size} bytes")
+    return copied
+
+
+def passthrough(job, progress=None):
+    """Copy a file that already matches the target using the cheapest strategy that works.
+
+    Records the chosen strategy and the bytes actually written in job.extra.
+    """
+    src = job.extra["source"]
+    dst = job.partial_path
+    if PASSTHROUGH_STRATEGY == "auto":
+        strategies = PASSTHROUGH_ORDER
+    else:
+        strategies = (PASSTHROUGH_STRATEGY, "remux")
+    try:
+        devices = (os.stat(src).st_dev, os.stat(os.path.dirname(dst)).st_dev)
+    except OSError as e:
+        # The input vanished or became unreadable after planning; fail this file only
+        print(f"Cannot pass through {job.filename}: {e}")
+        return 1
+
+    for strategy in strategies:
+        if (strategy,) + devices in _unsupported and strategy != "remux":
+            continue
+        discard_partial(job)
+        try:
+            with tracer.span(strategy, "copy", file=job.filename):
+                if strategy == "hardlink":
+                    written = hardlink_file(src, dst)
+                elif strategy == "reflink":
+                    written = reflink_file(src, dst)
+                elif strategy == "copy":
+                    written = kernel_copy_file(src, dst)
+                else:
+                    returncode = run_ffmpeg(job, progress)
+                    job.extra["strategy"] = "remux"
+                    job.extra["bytes_written"] = os.path.getsize(dst) if returncode == 0 else 0
+                    return returncode
+        except OSError as e:
+            if (strategy,) + devices not in _unsupported:
+                print(f"Pass-through by {strategy} unavailable for {job.filename} ({e}); trying the next strategy")
+            _unsupported.add((strategy,) + devices)
+            continue
+        job.extra["strategy"] = strategy
+        job.extra["bytes_written"] = written
+        return 0
+    discard_partial(job)
+    return 1
+
+
+def passthrough_summary(jobs):
+    """Summarise pass-through strategies, bytes written and the time saved versus remuxing."""
+    copies = [job for job in jobs if job.kind == "copy" and job.returncode == 0]
+    if not copies:
+        return None
+    counts = {}
+    for job in copies:
+        counts[job.extra.get("strategy")] = counts.get(job.extra.get("strategy"), 0) + 1
+    total = sum(job.extra.get("size", 0) for job in copies)
+    written = sum(job.extra.get("bytes_written", 0) for job in copies)
+    line = (", ".join(f"{n} {s}" for s, n in sorted(counts.items()))
+            + f"; {written / 1e6:.1f} of {total / 1e6:.1f} MB written")
+
+    # Estimate what a remux of every file would have cost, using the slowest measured strategy
+    for reference in ("remux", "copy"):
+        measured = [job for job in copies if job.extra.get("strategy") == reference]
+        measured_bytes = sum(job.extra.get("size", 0) for job in measured)
+        measured_time = sum(job.elapsed for job in measured)
+        if measured_bytes and measured_time and len(measured) < len(copies):
+            estimate = total * measured_time / measured_bytes
+            spent = sum(job.elapsed for job in copies)
+            line += f", ~{max(estimate - spent, 0):.1f}s saved vs. {reference} of every file"
+            break
+    return line
+
+
+# --------------------
+# ffmpeg build capabilities
+# --------------------
+def parse_encoders(text):
+    """Encoder names from `ffmpeg -encoders`, e.g. {"libx264": "V", "aac": "A"}."""
+    encoders = {}
+    listing = False
+    for line in text.splitlines():
+        if line.strip().startswith("------"):
+            listing = True
+        elif listing and line.strip():
+            flags, _, rest = line.strip().partition(" ")
+            encoders[rest.split()[0]] = flags[0]
+    return encoders
+
+
+def parse_filters(text):
+    """Filter names from `ffmpeg -filters`."""
+    return sorted(m.group(1) for m in re.finditer(r"^ [T.][S.][C.] (\S+)", text, re.MULTILINE))
+
+
+def parse_hwaccels(text):
+    """Methods listed by `ffmpeg -hwaccels`."""
+    lines = [line.strip() for line in text.splitlines()]
+    if "Hardware acceleration methods:" in lines:
+        lines = lines[lines.index("Hardware acceleration methods:") + 1:]
+    return [line for line in lines if line]
+
+
+def ffmpeg_capabilities():
+    """Return the local ffmpeg build profile: version, encoders, filters and hwaccels.
+
+    Listing these costs a few process spawns, so the profile is cached on disk keyed on
+    the binary's resolved path, size and mtime, and only rebuilt when ffmpeg changes.
+    """
+    binary = shutil.which("ffmpeg")
+    if binary is None:
+        return None
+    binary = os.path.realpath(binary)
+    st = os.stat(binary)
+    key = f"{binary}:{st.st_size}:{st.st_mtime_ns}"
+    cache_path = os.path.join(default_cache_dir(), "ffmpeg_profiles.json")
+    try:
+        with open(cache_path) as f:
+            profiles = json.load(f)
+    except (OSError, ValueError):
+        profiles = {}
+    if key in profiles:
+        return profiles[key]
+
+    def listing(flag):
+        return subprocess.run([binary, "-hide_banner", flag], capture_output=True, text=True).stdout
+
+    profile = {
+        "binary": binary,
+        "version": ffmpeg_version(),
+        "encoders": parse_encoders(listing("-encoders")),
+        "filters": parse_filters(listing("-filters")),
+        "hwaccels": parse_hwaccels(listing("-hwaccels")),
+    }
+    profiles[key] = profile
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    with open(cache_path + ".tmp", "w") as f:
+        json.dump(profiles, f, indent=1)
+    os.replace(cache_path + ".tmp", cache_path)
+    return profile
+
+
+def encoder_works(encoder):
+    """Encode a few blank frames with encoder. Hardware encoders are often compiled in but
+    have no device behind them, which only a real open of the encoder reveals."""
+    cmd = [
+        "ffmpeg", "-nostats", "-hide_banner", "-loglevel", "error",
+        "-f", "lavfi", "-i", "color=size=256x144:rate=25:duration=0.2",
+        "-c:v", encoder, "-f", "null", "-",
+    ]
+    result = subprocess.run(cmd, stdin=subprocess.DEVNULL, capture_output=True, text=True)
+    return result.returncode == 0, result.stderr.strip()
+
+
+def check_encoder():
+    """Validate the configured encoder before any job is built.
+
+    Falls back from GPU_ENCODER to VIDEO_CODEC when the GPU one is missing or unusable.
+    Returns False if no usable encoder is left, in which case nothing should be run.
+    """
+    global USE_GPU
+    profile = ffmpeg_capabilities()
+    if profile is None:
+        print("ffmpeg was not found on PATH")
+        return False
+    encoders = profile["encoders"]
+    if USE_GPU:
+        if GPU_ENCODER not in encoders:
+            print(f"GPU encoder {GPU_ENCODER} is not in this ffmpeg build; falling back to {VIDEO_CODEC}")
+            USE_GPU = False
+        else:
+            ok, error = encoder_works(GPU_ENCODER)
+            if not ok:
+                reason = error.splitlines()[-1] if error else "no details"
+                print(f"GPU encoder {GPU_ENCODER} cannot be opened on this machine ({reason}); "
+                      f"falling back to {VIDEO_CODEC}")
+                USE_GPU = False
+    if not USE_GPU and VIDEO_CODEC not in encoders:
+        print(f"Encoder {VIDEO_CODEC} is not in this ffmpeg build ({profile['version']})")
+        return False
+    if "scale" not in profile["filters"]:
+        print(f"The scale filter is missing from this ffmpeg build ({profile['version']})")
+        return False
+    return True
+
+
+# --------------------
+# Encoder Backends
+# --------------------
+@dataclass
+class EncoderBackend:
+    """How to drive one ffmpeg video encoder, and how it scales with threads.
+
+    PRESET names are x264's; presets maps them onto the encoder's own scale where it
+    differs. rate_control is formatted with crf, thread_args with threads.
+    """
+    name: str
+    hardware: bool = False
+    preset_flag: str = None
+    presets: dict = None
+    rate_control: tuple = ()
+    thread_args: tuple = ("-threads", "{threads}")
+    cpus_per_job: int = 4   # Cores one process keeps busy; MAX_JOBS defaults to CPUs / this
+    max_sessions: int = 0   # Concurrent encodes the hardware allows (0 = no limit)
+    memory_per_pixel: int = 200  # Rough peak RSS per target pixel: lookahead and reference frames
+    cpu_per_megapixel: float = 0.02  # Rough CPU seconds per megapixel-frame at preset "medium"
+
+    def args(self, preset, crf, threads):
+        args = ["-c:v", self.name]
+        if self.preset_flag:
+            args += [self.preset_flag, str((self.presets or {}).get(preset, preset))]
+        args += [a.format(crf=crf) for a in self.rate_control]
+        return args + [a.format(threads=threads) for a in self.thread_args]
+
+
+NVENC_PRESETS = {"ultrafast": "p1", "superfast": "p2", "veryfast": "p3", "faster": "p4",
+                 "fast": "p5", "medium": "p5", "slow": "p6", "slower": "p7", "veryslow": "p7"}
+QSV_PRESETS = {"ultrafast": "veryfast", "superfast": "veryfast"}
+AMF_QUALITY = {"ultrafast": "speed", "superfast": "speed", "veryfast": "speed", "faster": "speed",
+               "fast": "balanced", "medium": "balanced", "slow": "quality", "slower": "quality",
+               "veryslow": "quality"}
+
+ENCODERS = {backend.name: backend for backend in [
+    # x264 frame threading stops paying off after a few cores, so run more processes instead
+    EncoderBackend("libx264", preset_flag="-preset", rate_control=("-crf", "{crf}"), cpus_per_job=4),
+    # x265 runs WPP rows on a thread pool and keeps about twice as many cores busy
+    EncoderBackend("libx265", preset_flag="-preset", rate_control=("-crf", "{crf}"),
+                   thread_args=("-threads", "{threads}", "-x265-params", "pools={threads}:log-level=error"),
+                   cpus_per_job=8, memory_per_pixel=300, cpu_per_megapixel=0.08),
+    # SVT-AV1 is built to use a whole socket; its presets run 0 (slowest) to 13
+    EncoderBackend("libsvtav1", preset_flag="-preset",
+                   presets={"ultrafast": 12, "superfast": 11, "veryfast": 10, "faster": 9, "fast": 8,
+                            "medium": 6, "slow": 4, "slower": 3, "veryslow": 2},
+                   rate_control=("-crf", "{crf}"), thread_args=("-svtav1-params", "lp={threads}"),
+                   cpus_per_job=16, memory_per_pixel=500, cpu_per_megapixel=0.05),
+    # libvpx only scales with row multithreading; constant quality needs -b:v 0
+    EncoderBackend("libvpx-vp9", preset_flag="-cpu-used",
+                   presets={"ultrafast": 8, "superfast": 7, "veryfast": 6, "faster": 5, "fast": 4,
+                            "medium": 2, "slow": 1, "slower": 0, "veryslow": 0},
+                   rate_control=("-deadline", "good", "-crf", "{crf}", "-b:v", "0"),
+                   thread_args=("-threads", "{threads}", "-row-mt", "1"), cpus_per_job=4,
+                   memory_per_pixel=120, cpu_per_megapixel=0.08),
+    # Hardware encoders need a core or two each for decoding and scaling, not for the encode.
+    # GeForce drivers cap concurrent NVENC sessions, and one chip is saturated by a few anyway.
+    EncoderBackend("h264_nvenc", hardware=True, preset_flag="-preset", presets=NVENC_PRESETS,
+                   rate_control=("-rc", "vbr", "-cq", "{crf}", "-b:v", "0"), thread_args=(),
+                   cpus_per_job=2, max_sessions=3, memory_per_pixel=40, cpu_per_megapixel=0.002),
+    EncoderBackend("hevc_nvenc", hardware=True, preset_flag="-preset", presets=NVENC_PRESETS,
+                   rate_control=("-rc", "vbr", "-cq", "{crf}", "-b:v", "0"), thread_args=(),
+                   cpus_per_job=2, max_sessions=3, memory_per_pixel=40, cpu_per_megapixel=0.002),
+    EncoderBackend("av1_nvenc", hardware=True, preset_flag="-preset", presets=NVENC_PRESETS,
+                   rate_control=("-rc", "vbr", "-cq", "{crf}", "-b:v", "0"), thread_args=(),
+                   cpus_per_job=2, max_sessions=3, memory_per_pixel=40, cpu_per_megapixel=0.002),
+    EncoderBackend("h264_qsv", hardware=True, preset_flag="-preset", presets=QSV_PRESETS,
+                   rate_control=("-global_quality", "{crf}"), thread_args=(), cpus_per_job=2,
+                   memory_per_pixel=40, cpu_per_megapixel=0.002),
+    EncoderBackend("hevc_qsv", hardware=True, preset_flag="-preset", presets=QSV_PRESETS,
+                   rate_control=("-global_quality", "{crf}"), thread_args=(), cpus_per_job=2,
+                   memory_per_pixel=40, cpu_per_megapixel=0.002),
+    EncoderBackend("h264_amf", hardware=True, preset_flag="-quality", presets=AMF_QUALITY,
+                   rate_control=("-rc", "cqp", "-qp_i", "{crf}", "-qp_p", "{crf}"), thread_args=(),
+                   cpus_per_job=2, memory_per_pixel=40, cpu_per_megapixel=0.002),
+    EncoderBackend("hevc_amf", hardware=True, preset_flag="-quality", presets=AMF_QUALITY,
+                   rate_control=("-rc", "cqp", "-qp_i", "{crf}", "-qp_p", "{crf}"), thread_args=(),
+                   cpus_per_job=2, memory_per_pixel=40, cpu_per_megapixel=0.002),
+]}
+
+
+def active_encoder():
+    """The backend re-encoded video goes through: GPU_ENCODER if USE_GPU, else VIDEO_CODEC."""
+    name = GPU_ENCODER if USE_GPU else VIDEO_CODEC
+    # An encoder the registry does not know gets no preset or rate control, only its name
+    return ENCODERS.get(name) or EncoderBackend(name, hardware=USE_GPU, thread_args=())
+
+
+def video_encoder_args(threads):
+    """Encoder arguments for re-encoded video, including the per-job thread settings."""
+    return active_encoder().args(PRESET, CRF_VALUE, threads)
+
+
+def list_encoders():
+    """Print the registry and which backends this ffmpeg build and machine can use."""
+    profile = ffmpeg_capabilities()
+    compiled = profile["encoders"] if profile else {}
+    cpus = available_cpus()
+    print(f"{'encoder':<12} {'type':<9} {'status':<14} {'jobs':>4} {'threads':>7}")
+    for backend in ENCODERS.values():
+        if backend.name not in compiled:
+            status = "not built in"
+        elif backend.hardware:
+            status = "ok" if encoder_works(backend.name)[0] else "no device"
+        else:
+            status = "ok"
+        jobs, threads = plan_concurrency(MAX_JOBS, THREADS_PER_JOB, cpus, backend)
+        kind = "hardware" if backend.hardware else "software"
+        print(f"{backend.name:<12} {kind:<9} {status:<14} {jobs:>4} {threads:>7}")
+
+
+# --------------------
+# Cost Model
+# --------------------
+# Relative cost of the x264 preset names, which every backend's presets are mapped from
+PRESET_COST = {"ultrafast": 0.2, "superfast": 0.3, "veryfast": 0.45, "faster": 0.6, "fast": 0.8,
+               "medium": 1.0, "slow": 1.6, "slower": 3.0, "veryslow": 6.0}
+COPY_BYTES_PER_SECOND = 500e6  # Pass-through cost when the strategy is not known yet
+DEFAULT_FPS = 25.0
+OUTPUT_BITS_PER_PIXEL = 0.1    # Rough encoded size at CRF 18; halves with every +6 CRF
+AUDIO_BITS_PER_SECOND = 128e3  # Rough size of each audio stream carried over
+
+
+def estimate_job(job, probe, threads, history=None):
+    """Store the predicted wall seconds of job in job.extra["estimate"].
+
+    Encodes cost duration x fps x target megapixels x seconds per megapixel-frame,
+    taken from history for this encoder setting when it has any, else from the
+    backend's CPU seconds at PRESET spread over the job's threads. Pass-through costs
+    its byte size. A split job is estimated for its whole chain, and also gets the
+    estimates of the segment encodes it will queue in job.extra["estimate_parts"].
+    """
+    copy_rate = (history and history.copy_rate()) or COPY_BYTES_PER_SECOND
+    if job.kind == "copy":
+        job.extra["estimate"] = job.extra.get("size", 0) / copy_rate
+        return
+    backend = active_encoder()
+    per_frame = history and history.encode_rate(backend.name, PRESET, CRF_VALUE, threads)
+    if not per_frame:
+        factor = 1.0 if backend.hardware else PRESET_COST.get(PRESET, 1.0)
+        per_frame = backend.cpu_per_megapixel * factor / max(threads, 1)
+    target_pixels = job.extra.get("target_pixels") or job.extra.get("chain_target_pixels", 0)
+    frames = probe.duration * (probe.fps or DEFAULT_FPS)
+    encode = frames * target_pixels / 1e6 * per_frame
+    if job.kind == "split":
+        pieces = max(1, round(probe.duration / SEGMENT_SECONDS))
+        split = job.extra.get("size", 0) / copy_rate
+        job.extra["estimate_parts"] = [encode / pieces] * pieces
+        job.extra["estimate"] = split + encode
+    else:
+        job.extra["estimate"] = encode
+
+
+def estimate_output_size(job, probe):
+    """Rough size in bytes of job's output: the input for pass-through, else from CRF and pixels."""
+    if job.kind == "copy":
+        return job.extra.get("size", 0)
+    target_pixels = job.extra.get("target_pixels") or job.extra.get("chain_target_pixels", 0)
+    frames = probe.duration * (probe.fps or DEFAULT_FPS)
+    bits = frames * target_pixels * OUTPUT_BITS_PER_PIXEL * 2 ** ((18 - CRF_VALUE) / 6)
+    bits += probe.duration * AUDIO_BITS_PER_SECOND * len(probe.audio_streams)
+    return int(bits / 8)
+
+
+def predict_makespan(jobs, workers):
+    """Simulate run_jobs on workers slots with estimated durations; returns the batch wall time.
+
+    Like run_jobs, the segment encodes a split job queues go to the front of the queue
+    once the split has finished.
+    """
+    pending = deque((job.extra.get("estimate", 0.0), job.extra.get("estimate_parts", [])) for job in jobs)
+    running = []  # heap of (finish time, tiebreak, parts queued on finish)
+    clock = 0.0
+    tiebreak = 0
+    while pending or running:
+        while pending and len(running) < workers:
+            cost, parts = pending.popleft()
+            # A split job's estimate covers its whole chain; the split itself is the remainder
+            heapq.heappush(running, (clock + cost - sum(parts), tiebreak, parts))
+            tiebreak += 1
+        clock, _, parts = heapq.heappop(running)
+        pending.extendleft(reversed([(cost, []) for cost in parts]))
+    return clock
+
+
+class History:
+    """SQLite log of finished jobs, used to predict how long future jobs will take."""
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(default_cache_dir(), "history.sqlite")
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.db = sqlite3.connect(self.path)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " finished REAL, kind TEXT, strategy TEXT, encoder TEXT, preset TEXT, crf INTEGER,"
+            " input_width INTEGER, input_height INTEGER, target_width INTEGER, target_height INTEGER,"
+            " fps REAL, duration REAL, frames INTEGER, size INTEGER, threads INTEGER, jobs INTEGER,"
+            " wall REAL, cpu REAL)"
+        )
+
+    def add(self, job, target, threads, jobs):
+        """Record a finished job; failed ones say nothing about speed and are left out."""
+        if job.returncode != 0:
+            return
+        usage = job.extra.get("rusage")
+        w, h = job.extra.get("input_resolution") or (None, None)
+        encodes = job.kind in ("scale", "segment")
+        self.db.execute(
+            "INSERT INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (time.time(), job.kind, job.extra.get("strategy"),
+             active_encoder().name if encodes else None, PRESET if encodes else None,
+             CRF_VALUE if encodes else None, w, h, target[0], target[1],
+             job.extra.get("fps"), job.extra.get("duration"), job.extra.get("frames"), job.extra.get("size"),
+             threads, jobs, job.elapsed, usage["user"] + usage["sys"] if usage else None),
+        )
+        self.db.commit()
+
+    def count(self):
+        return self.db.execute("SELECT COUNT(*) FROM jobs").fetchone()[0]
+
+    def encode_rate(self, encoder, preset, crf, threads):
+        """Median wall seconds per megapixel-frame for an encoder setting, or None without history.
+
+        Jobs that ran with the same -threads are used as they are; otherwise their CPU
+        time is spread over threads.
+        """
+        rows = self.db.execute(
+            "SELECT wall, cpu, frames * target_width * target_height / 1e6, threads FROM jobs"
+            " WHERE kind IN ('scale', 'segment') AND encoder = ? AND preset = ? AND crf = ? AND frames > 0"
+            " ORDER BY finished DESC LIMIT ?",
+            (encoder, preset, crf, HISTORY_WINDOW),
+        ).fetchall()
+        same = [wall / mpf for wall, _, mpf, used in rows if used == threads]
+        if same:
+            return statistics.median(same)
+        spread = [cpu / mpf / max(threads, 1) for _, cpu, mpf, _ in rows if cpu]
+        return statistics.median(spread) if spread else None
+
+    def copy_rate(self):
+        """Median bytes per second of recent pass-through copies, or None."""
+        rows = self.db.execute(
+            "SELECT size / wall FROM jobs WHERE kind = 'copy' AND wall > 0 AND size > 0"
+            " ORDER BY finished DESC LIMIT ?",
+            (HISTORY_WINDOW,),
+        ).fetchall()
+        return statistics.median(r[0] for r in rows) if rows else None
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+
+def build_job(filename, probe, target, threads, max_jobs=1, cache=None):
+    """Build the ffmpeg job that conforms one file to target (width, height)."""
+    full_path = os.path.join(FOLDER_PATH, filename)
+    output_path = os.path.join(OUTPUT_DIR, filename)
+    partial_path = partial_path_for(output_path)
+    max_width, max_height = target
+    w, h = probe.width, probe.height
+
+    # If resolution already matches the highest, do pass-through copy
+    if w == max_width and h == max_height:
+        kind = "copy"
+        cmd = [
+            "ffmpeg",
+            "-y",
+            "-nostats", "-loglevel", "error",
+            "-i", full_path,
+            "-c", "copy",  # Copy video & audio
+            partial_path
+        ]
+        job = Job(filename, kind, cmd, action=passthrough, output_path=output_path,
+                  partial_path=partial_path, signature=job_signature(full_path, kind, target))
+        job.extra["source"] = full_path
+        job.extra["size"] = os.path.getsize(full_path)
+        job.extra["duration"] = probe.duration
+        job.extra["fps"] = probe.fps
+        job.extra["input_resolution"] = [w, h]
+        return job
+    elif SEGMENT_ENCODING and max_jobs > 1 and probe.duration >= SEGMENT_MIN_DURATION:
+        # Long input: split it and let the pool encode the pieces side by side
+        return build_segmented_job(filename, full_path, output_path, target, threads,
+                                   job_signature(full_path, "scale", target),
+                                   keyframe_index(full_path, cache), probe.duration, [w, h])
+    else:
+        # Otherwise, scale to the highest resolution
+        kind = "scale"
+        cmd = [
+            "ffmpeg",
+            "-y",
+            "-nostats", "-loglevel", "error",
+            "-i", full_path,
+            "-vf", f"scale={max_width}:{max_height}"
+        ] + video_encoder_args(threads) + [
+            "-c:a", AUDIO_CODEC,
+            partial_path
+        ]
+
+    job = Job(filename, kind, cmd, output_path=output_path, partial_path=partial_path,
+              signature=job_signature(full_path, kind, target))
+    job.extra["duration"] = probe.duration
+    job.extra["fps"] = probe.fps
+    job.extra["size"] = os.path.getsize(full_path)
+    job.extra["target_pixels"] = max_width * max_height
+    job.extra["input_resolution"] = [w, h]
+    job.extra["encoder"] = encoder_label()
+    return job
+
+
+def build_segmented_job(filename, full_path, output_path, target, threads, signature,
+                        keyframes=None, duration=0.0, input_resolution=None, cuts=None, argv=None):
+    """Build a split -> parallel segment encodes -> concat chain for one long input.
+
+    The returned "split" job stream-copies the video into keyframe-aligned pieces, cut at
+    keyframes chosen from the keyframe index when one is available (or at the given
+    cut times, e.g. from a saved plan). Its
+    followups are one "segment" encode per piece, and the last segment to finish queues
+    a "concat" job that joins the encoded pieces losslessly with the concat demuxer and
+    takes the audio once from the original input.
+
+    With cut times the number of pieces is known up front, and job.extra["argv"] holds
+    every command of the chain. argv, in that form, runs a saved plan's commands instead;
+    a split that produces a different number of pieces then fails.
+    """
+    work_dir = segment_work_dir(output_path)
+    partial_path = partial_path_for(output_path)
+    max_width, max_height = target
+
+    if cuts is None and keyframes:
+        cuts = plan_segment_times(keyframes, duration)
+    if cuts:
+        # The muxer cuts at the first keyframe at or after each time; nudge below float rounding
+        split_at = ["-segment_times", ",".join(f"{max(t - 0.001, 0):.3f}" for t in cuts)]
+    else:
+        split_at = ["-segment_time", str(SEGMENT_SECONDS)]
+
+    split_cmd = argv["split"] if argv else [
+        "ffmpeg",
+        "-y",
+        "-nostats", "-loglevel", "error",
+        "-i", full_path,
+        "-map", "0:v:0",
+        "-c", "copy",
+        "-f", "segment",
+    ] + split_at + [
+        "-reset_timestamps", "1",
+        os.path.join(work_dir, "src_%05d.mkv"),
+    ]
+
+    def segment_cmd(i):
+        return [
+            "ffmpeg",
+            "-y",
+            "-nostats", "-loglevel", "error",
+            "-i", os.path.join(work_dir, f"src_{i:05d}.mkv"),
+            "-vf", f"scale={max_width}:{max_height}"
+        ] + video_encoder_args(threads) + [
+            "-an",
+            os.path.join(work_dir, f"enc_{i:05d}.mkv")
+        ]
+
+    list_path = os.path.join(work_dir, "segments.txt")
+    concat_cmd = argv["concat"] if argv else [
+        "ffmpeg",
+        "-y",
+        "-nostats", "-loglevel", "error",
+        "-f", "concat", "-safe", "0", "-i", list_path,
+        "-i", full_path,
+        "-map", "0:v:0", "-map", "1:a?",
+        "-map_metadata", "1",
+        "-c:v", "copy",
+        "-c:a", AUDIO_CODEC,
+        partial_path
+    ]
+
+    def concat_job():
+        with open(list_path, "w") as f:
+            for i in range(state["count"]):
+                f.write(f"file 'enc_{i:05d}.mkv'\n")
+        job = Job(filename, "concat", concat_cmd, output_path=output_path, partial_path=partial_path,
+                  signature=signature)
+        job.followups = lambda job: shutil.rmtree(work_dir, ignore_errors=True) or []
+        return job
+
+    def segment_done(job):
+        state["remaining"] -= 1
+        state["failed"] |= job.returncode != 0
+        if state["remaining"]:
+            return []
+        if state["failed"]:
+            shutil.rmtree(work_dir, ignore_errors=True)
+            return []
+        return [concat_job()]
+
+    def split_done(job):
+        if job.returncode != 0:
+            shutil.rmtree(work_dir, ignore_errors=True)
+            return []
+        sources = sorted(f for f in os.listdir(work_dir) if f.startswith("src_"))
+        state["count"] = state["remaining"] = len(sources)
+        segments = []
+        for i in range(len(sources)):
+            cmd = argv["segments"][i] if argv else segment_cmd(i)
+            segment = Job(filename, "segment", cmd, followups=segment_done)
+            segment.extra["part"] = (i + 1, len(sources))
+            segment.extra["target_pixels"] = max_width * max_height
+            segment.extra["input_resolution"] = input_resolution
+            segment.extra["encoder"] = encoder_label()
+            if cuts and len(cuts) + 1 == len(sources):
+                bounds = [0.0] + cuts + [duration]
+                segment.extra["duration"] = bounds[i + 1] - bounds[i]
+            else:
+                segment.extra["duration"] = duration / len(sources)
+            segments.append(segment)
+        return segments
+
+    def split_as_planned(job, progress):
+        returncode = run_ffmpeg(job, progress)
+        pieces = sum(f.startswith("src_") for f in os.listdir(work_dir)) if returncode == 0 else 0
+        if returncode == 0 and pieces != len(argv["segments"]):
+            print(f"[split] {filename}: cut into {pieces} piece(s) where the plan has "
+                  f"{len(argv['segments'])}; plan again")
+            return 1
+        return returncode
+
+    state = {"count": 0, "remaining": 0, "failed": False}
+    job = Job(filename, "split", split_cmd, action=split_as_planned if argv else None,
+              output_path=output_path, signature=signature, work_dir=work_dir, followups=split_done)
+    job.extra["size"] = os.path.getsize(full_path)
+    job.extra["input_resolution"] = input_resolution
+    job.extra["chain_target_pixels"] = max_width * max_height
+    job.extra["cuts"] = cuts
+    if cuts:
+        job.extra["argv"] = {"split": split_cmd, "segments": [segment_cmd(i) for i in range(len(cuts) + 1)],
+                             "concat": concat_cmd}
+    return job
+
+
+def try_build_job(filename, probe, target, threads, max_jobs=1, cache=None):
+    """build_job(), or None after reporting why filename cannot be conformed.
+
+    A file that failed to probe, or vanished since it was listed, is counted as failed
+    rather than ending the whole batch.
+    """
+    try:
+        if not probe.pixels:
+            raise ValueError("could not read its resolution")
+        return build_job(filename, probe, target, threads, max_jobs, cache)
+    except (OSError, ValueError) as e:
+        print(f"Cannot conform {filename}: {e}")
+        metrics.inc("conform_files_total", action="failed")
+        return None
+
+
+# --------------------
+# Metrics
+# --------------------
+SECONDS_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600, 14400)
+PIXEL_RATE_BUCKETS = (1e6, 1e7, 5e7, 1e8, 2.5e8, 5e8, 1e9, 2.5e9, 5e9)
+
+METRIC_DEFS = {
+    "conform_files_probed_total": ("counter", "Files probed, by source (cache, mp4 parser or ffprobe)."),
+    "conform_probe_seconds": ("histogram", "Latency of one probe, by engine.", SECONDS_BUCKETS),
+    "conform_jobs_total": ("counter", "Finished jobs by kind and result (ok or failed)."),
+    "conform_job_failures_total": ("counter", "Failed jobs by kind."),
+    "conform_files_total": ("counter", "Files handled, by action (passthrough, reencode, skipped or failed)."),
+    "conform_passthrough_total": ("counter", "Pass-through copies by strategy."),
+    "conform_job_seconds": ("histogram", "Wall time of one job, by kind.", SECONDS_BUCKETS),
+    "conform_encode_pixels_per_second": ("histogram", "Output pixels encoded per second by one job.",
+                                         PIXEL_RATE_BUCKETS),
+    "conform_bytes_in_total": ("counter", "Bytes of input read by jobs."),
+    "conform_bytes_out_total": ("counter", "Bytes of output produced by jobs."),
+    "conform_running_jobs": ("gauge", "Jobs currently running."),
+    "conform_batch_fps": ("gauge", "Frames per second across all running jobs."),
+    "conform_batch_speed": ("gauge", "Sum of the realtime factors of all running jobs."),
+}
+
+
+class Metrics:
+    """Counters, gauges and histograms rendered in the Prometheus text exposition format."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}      # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> [bucket counts..., sum, count]
+        self.progress = None  # BatchProgress whose snapshot feeds the gauges
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        buckets = METRIC_DEFS[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            h = self.histograms.setdefault(key, [0] * (len(buckets) + 2))
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    h[i] += 1
+            h[-2] += value
+            h[-1] += 1
+
+    def render(self):
+        if self.progress:
+            snap = self.progress.snapshot()
+            with self.lock:
+                self.values[("conform_running_jobs", ())] = snap["running"]
+                self.values[("conform_batch_fps", ())] = snap["fps"]
+                self.values[("conform_batch_speed", ())] = snap["speed"]
+
+        def fmt_labels(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ""
+            return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+        lines = []
+        with self.lock:
+            for name, (kind, help_text, *rest) in METRIC_DEFS.items():
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                if kind == "histogram":
+                    for (n, labels), h in sorted(self.histograms.items()):
+                        if n != name:
+                            continue
+                        for bound, count in zip(rest[0], h):
+                            lines.append(f"{name}_bucket{fmt_labels(labels, [('le', bound)])} {count}")
+                        lines.append(f"{name}_bucket{fmt_labels(labels, [('le', '+Inf')])} {h[-1]}")
+                        lines.append(f"{name}_sum{fmt_labels(labels)} {h[-2]}")
+                        lines.append(f"{name}_count{fmt_labels(labels)} {h[-1]}")
+                else:
+                    for (n, labels), value in sorted(self.values.items()):
+                        if n == name:
+                            lines.append(f"{name}{fmt_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path):
+        """Write the metrics atomically, as node_exporter's textfile collector expects."""
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(self.render())
+        os.replace(tmp_path, path)
+
+    def serve(self, port):
+        """Serve /metrics on localhost:port from a daemon thread."""
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry.render().encode()
+                self.send_response(200 if self.path.startswith("/metrics") else 404)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+metrics = Metrics()
+
+
+class Tracer:
+    """Records spans as Chrome trace events, one lane per thread. Disabled spans cost next to nothing."""
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.events = []
+        self.lanes = {}  # thread name -> lane id
+        self.origin = time.perf_counter()
+
+    def lane(self):
+        name = threading.current_thread().name
+        with self.lock:
+            if name not in self.lanes:
+                self.lanes[name] = len(self.lanes) + 1
+            return self.lanes[name]
+
+    @contextmanager
+    def span(self, name, cat, **args):
+        if not self.enabled:
+            yield
+            return
+        lane = self.lane()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            event = {
+                "name": name, "cat": cat, "ph": "X", "pid": 1, "tid": lane,
+                "ts": (start - self.origin) * 1e6, "dur": (end - start) * 1e6, "args": args,
+            }
+            with self.lock:
+                self.events.append(event)
+
+    def write(self, path):
+        with self.lock:
+            meta = [
+                {"name": "thread_name", "ph": "M", "pid": 1, "tid": lane, "args": {"name": name}}
+                for name, lane in self.lanes.items()
+            ]
+            meta.append({"name": "process_name", "ph": "M", "pid": 1, "args": {"name": "conformvids"}})
+            data = {"traceEvents": meta + self.events, "displayTimeUnit": "ms"}
+        with open(path, "w") as f:
+            json.dump(data, f)
+
+
+tracer = Tracer()
+
+
+def record_job_metrics(job):
+    """Feed one finished job into the metrics registry."""
+    ok = job.returncode == 0
+    metrics.inc("conform_jobs_total", kind=job.kind, result="ok" if ok else "failed")
+    metrics.observe("conform_job_seconds", job.elapsed, kind=job.kind)
+    if not ok:
+        metrics.inc("conform_job_failures_total", kind=job.kind)
+        return
+    if job.kind in ("copy", "scale", "split"):
+        metrics.inc("conform_bytes_in_total", job.extra.get("size", 0))
+    if job.kind in ("copy", "scale", "concat"):
+        metrics.inc("conform_bytes_out_total", os.path.getsize(job.output_path))
+        action = "passthrough" if job.kind == "copy" else "reencode"
+        metrics.inc("conform_files_total", action=action)
+    if job.kind == "copy":
+        metrics.inc("conform_passthrough_total", strategy=job.extra.get("strategy"))
+    frames = job.extra.get("frames")
+    if job.kind in ("scale", "segment") and frames and job.elapsed > 0:
+        metrics.observe("conform_encode_pixels_per_second",
+                        frames * job.extra.get("target_pixels", 0) / job.elapsed)
+
+
+def encoder_label():
+    """Short description of the encoder setting, used to group resource usage."""
+    if USE_GPU:
+        return GPU_ENCODER
+    return f"{VIDEO_CODEC} preset={PRESET} crf={CRF_VALUE}"
+
+
+def cpu_per_megapixel_frame(jobs):
+    """Return {encoder setting: CPU-seconds per megapixel-frame} over the encode jobs."""
+    totals = {}
+    for job in jobs:
+        usage = job.extra.get("rusage")
+        frames = job.extra.get("frames")
+        if job.kind not in ("scale", "segment") or job.returncode != 0 or not usage or not frames:
+            continue
+        cpu, mpx = totals.get(job.extra["encoder"], (0.0, 0.0))
+        totals[job.extra["encoder"]] = (
+            cpu + usage["user"] + usage["sys"],
+            mpx + frames * job.extra.get("target_pixels", 0) / 1e6,
+        )
+    return {encoder: cpu / mpx for encoder, (cpu, mpx) in totals.items() if mpx}
+
+
+def write_report(output_dir, jobs, wall, predicted=None):
+    """Write per-job resolution, duration, timing and rusage to REPORT_NAME in output_dir."""
+    report = {
+        "wall_seconds": wall,
+        "predicted_wall_seconds": predicted,
+        "cpu_seconds_per_megapixel_frame": cpu_per_megapixel_frame(jobs),
+        "jobs": [
+            {
+                "file": job.filename,
+                "kind": job.kind,
+                "part": job.extra.get("part"),
+                "input_resolution": job.extra.get("input_resolution"),
+                "target_pixels": job.extra.get("target_pixels"),
+                "duration": job.extra.get("duration"),
+                "frames": job.extra.get("frames"),
+                "encoder": job.extra.get("encoder"),
+                "strategy": job.extra.get("strategy"),
+                "returncode": job.returncode,
+                "elapsed": job.elapsed,
+                "estimate": job.extra.get("estimate"),
+                "rusage": job.extra.get("rusage"),
+                "memory_estimate": job.extra.get("memory_estimate"),
+                "memory_wait": job.extra.get("memory_wait"),
+            }
+            for job in jobs
+        ],
+    }
+    path = os.path.join(output_dir, REPORT_NAME)
+    with open(path + ".tmp", "w") as f:
+        json.dump(report, f, indent=1)
+    os.replace(path + ".tmp", path)
+
+
+def print_summary(jobs, wall):
+    """Print wall-clock vs. serial time for a batch."""
+    serial = sum(job.elapsed for job in jobs)
+    failed = list(dict.fromkeys(job.filename for job in jobs if job.returncode != 0))
+    speedup = serial / wall if wall > 0 else 0.0
+    print(f"{len(jobs)} jobs, {len(failed)} failed. "
+          f"Wall clock {wall:.1f}s vs. serial {serial:.1f}s ({speedup:.2f}x)")
+    for filename in failed:
+        print(f"  failed: {filename}")
+    copies = passthrough_summary(jobs)
+    if copies:
+        print(f"Pass-through: {copies}")
+    usages = [job.extra["rusage"] for job in jobs if "rusage" in job.extra]
+    if usages:
+        cpu = sum(u["user"] + u["sys"] for u in usages)
+        peak = max(u["max_rss_kb"] for u in usages)
+        print(f"ffmpeg CPU time {cpu:.1f}s, peak RSS {peak / 1024:.0f} MB")
+    for encoder, cost in cpu_per_megapixel_frame(jobs).items():
+        print(f"  {encoder}: {cost * 1000:.2f} CPU-ms per megapixel-frame")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Conform all videos in a folder to the resolution of the largest one."
+    )
+    parser.add_argument(
+        "command", nargs="?", default="run",
+        choices=["run", "plan", "prune-cache", "bench-probe", "bench", "bench-overhead", "calibrate", "encoders"],
+        help="run: conform FOLDER_PATH (default). plan: probe FOLDER_PATH and print the jobs a run would "
+             "start and its expected runtime, predicted from past jobs. prune-cache: drop stale probe cache entries. "
+             "bench-probe: compare the MP4 header parser with ffprobe on FOLDER_PATH. "
+             "bench: run the pipeline on generated test clips and write JSON timings. "
+             "bench-overhead: measure orchestration overhead with stub ffmpeg/ffprobe. "
+             "calibrate: find the fastest VIDEO_CODEC preset/CRF meeting QUALITY_THRESHOLD on FOLDER_PATH. "
+             "encoders: list the encoder backends, whether they work here and their job sizing.",
+    )
+    parser.add_argument("--no-cache", action="store_true", help="ignore the probe cache for this run")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue an interrupted run, skipping files the journal records as done")
+    parser.add_argument("--trace", metavar="PATH", help="write a Chrome trace-event JSON of the run to PATH")
+    parser.add_argument("--force", action="store_true", help="re-process every file even if its output is up to date")
+    parser.add_argument("--plan", metavar="PATH",
+                        help="probe and plan as the plan command does, and write the JSON plan to PATH; nothing is encoded")
+    parser.add_argument("--execute-plan", metavar="PATH",
+                        help="run the jobs of a plan written by --plan instead of planning afresh")
+    parser.add_argument("--adaptive", action="store_true",
+                        help="tune the number of running jobs from measured throughput (ADAPTIVE_CONCURRENCY)")
+    parser.add_argument("--repeat", type=int, default=1,
+                        help="bench-probe: probe each file this many times. bench: number of runs")
+    parser.add_argument("--scenario", default="smoke", choices=sorted(BENCH_SCENARIOS),
+                        help="bench: which synthetic folder to run on")
+    parser.add_argument("--bench-dir", help="bench: where generated clips are kept (default: user cache dir)")
+    parser.add_argument("--out", help="bench: JSON results file (default: bench-<scenario>.json)")
+    parser.add_argument("--verbose", action="store_true", help="bench: show the pipeline's normal output")
+    parser.add_argument("--files", type=int, default=100000, help="bench-overhead: number of fake files")
+    parser.add_argument("--probe-sleep", type=float, default=0.0, help="bench-overhead: seconds each fake ffprobe takes")
+    parser.add_argument("--encode-sleep", type=float, default=0.0, help="bench-overhead: seconds each fake ffmpeg takes")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    if args.command == "prune-cache":
+        cache = ProbeCache(PROBE_CACHE_PATH)
+        removed = cache.prune()
+        cache.close()
+        print(f"Removed {removed} stale entries from {cache.path}")
+        return
+    if args.command == "bench-probe":
+        bench_probe(FOLDER_PATH, args.repeat)
+        return
+    if args.command == "bench":
+        bench(args)
+        return
+    if args.command == "bench-overhead":
+        bench_overhead(args)
+        return
+    if args.command == "calibrate":
+        calibrate(args)
+        return
+    if args.command == "encoders":
+        list_encoders()
+        return
+    if args.command == "plan" or args.plan:
+        plan(args)
+        return
+
+    if METRICS_PORT:
+        metrics.serve(METRICS_PORT)
+        print(f"Serving metrics on http://127.0.0.1:{METRICS_PORT}/metrics")
+
+    trace_path = args.trace or TRACE_PATH
+    tracer.enabled = bool(trace_path)
+    try:
+        if args.execute_plan:
+            execute_plan(args)
+        else:
+            run(args)
+    finally:
+        if trace_path:
+            tracer.write(trace_path)
+            print(f"Wrote trace to {trace_path}")
+
+
+def discover(args):
+    """Steps 1-2 of a run: list the MP4s in FOLDER_PATH, probe them and pick the target.
+
+    Returns {"files", "probes", "target", "probe_seconds", "cache"}, or None if there
+    is nothing to conform. The caller closes "cache" (None when caching is off).
+    """
+    # 1. Gather all MP4 files
+    with tracer.span("discovery", "io", folder=FOLDER_PATH):
+        mp4_files = [f for f in os.listdir(FOLDER_PATH) if f.lower().endswith(".mp4")]
+    if not mp4_files:
+        print(f"No MP4 files found in {FOLDER_PATH}")
+        return None
+
+    # 2. Probe every file once and find the one with the highest resolution
+    probes = {}
+    max_pixels = 0
+    max_width, max_height = 0, 0
+    max_res_file = None
+    order = {filename: i for i, filename in enumerate(mp4_files)}
+
+    probe_start = time.perf_counter()
+    cache = ProbeCache(PROBE_CACHE_PATH) if USE_PROBE_CACHE and not args.no_cache else None
+    for filename, probe in probe_files(mp4_files, FOLDER_PATH, cache, PROBE_WORKERS):
+        probes[filename] = probe
+        # Results arrive out of order; break ties by listing order so the pick is stable
+        if probe.pixels > max_pixels or (
+            probe.pixels == max_pixels and max_res_file and order[filename] < order[max_res_file]
+        ):
+            max_pixels = probe.pixels
+            max_width, max_height = probe.width, probe.height
+            max_res_file = filename
+    probe_time = time.perf_counter() - probe_start
+
+    cache_note = ""
+    if cache:
+        cache_note = f" (probe cache: {cache.hits} hits, {cache.misses} misses)"
+    print(f"Probed {len(probes)} files in {probe_time:.2f}s with {PROBE_WORKERS} worker(s){cache_note}")
+
+    if not max_res_file:
+        print("Could not determine a file with the highest resolution.")
+        if cache:
+            cache.close()
+        return None
+
+    print(f"Highest resolution: {max_width}x{max_height} ({max_pixels} pixels), from file: {max_res_file}")
+    return {
+        "files": mp4_files,
+        "probes": probes,
+        "target": (max_width, max_height),
+        "probe_seconds": probe_time,
+        "cache": cache,
+    }
+
+
+def order_jobs(jobs, max_jobs):
+    """Sort jobs longest-first if LONGEST_FIRST, print the predicted makespan and return it."""
+    predicted = predict_makespan(jobs, max_jobs)
+    if LONGEST_FIRST and jobs:
+        listing = predicted
+        jobs.sort(key=lambda job: job.extra["estimate"], reverse=True)
+        predicted = predict_makespan(jobs, max_jobs)
+        print(f"Predicted makespan {predicted:.1f}s longest-first ({listing:.1f}s in listing order)")
+    elif jobs:
+        print(f"Predicted makespan {predicted:.1f}s")
+    return predicted
+
+
+def plan(args):
+    """Print what a run would do and how long it is expected to take, without encoding."""
+    if CHECK_ENCODER and not check_encoder():
+        return None
+    if USE_CALIBRATION and not USE_GPU:
+        apply_calibration()
+    found = discover(args)
+    if found is None:
+        return None
+    cache, probes, target = found["cache"], found["probes"], found["target"]
+    resources = effective_resources()
+    max_jobs, threads = plan_concurrency(MAX_JOBS, THREADS_PER_JOB, resources["cpus"],
+                                         memory=resources["total_memory"])
+    print(f"Resources: {describe_resources(resources)}")
+    history = History(HISTORY_PATH) if USE_HISTORY else None
+    if history and history.count():
+        print(f"Predicting from {history.count()} finished job(s) in {history.path}")
+    else:
+        print("No job history yet; predicting from the built-in encoder cost model")
+
+    manifest = load_manifest(OUTPUT_DIR) if INCREMENTAL and not args.force else {}
+    jobs = []
+    skipped = []
+    failed = 0
+    for filename in found["files"]:
+        job = try_build_job(filename, probes[filename], target, threads, max_jobs, cache)
+        if job is None:
+            failed += 1
+            continue
+        if is_up_to_date(manifest, job):
+            skipped.append(plan_entry(job, probes[filename], "output is up to date"))
+            continue
+        estimate_job(job, probes[filename], threads, history)
+        jobs.append(job)
+    if cache:
+        cache.close()
+    if history:
+        history.close()
+    predicted = order_jobs(jobs, max_jobs)
+    for job in jobs:
+        print(f"  {job.extra['estimate']:8.1f}s  {job.kind:<6} {job.filename}")
+    serial = sum(job.extra["estimate"] for job in jobs)
+    if failed:
+        print(f"{failed} file(s) cannot be conformed and are left out")
+    print(f"{len(jobs)} job(s) to run, {len(skipped)} up to date. "
+          f"Expected runtime {predicted:.1f}s with {max_jobs} concurrent {active_encoder().name} job(s) "
+          f"x {threads} thread(s) ({serial:.1f}s serial)")
+
+    if args.plan:
+        saved = {
+            "version": PLAN_VERSION,
+            "created": time.time(),
+            "host": platform.node(),
+            "revision": source_revision(),
+            "ffmpeg": ffmpeg_version(),
+            "folder": FOLDER_PATH,
+            "output_dir": OUTPUT_DIR,
+            "target": list(target),
+            "max_jobs": max_jobs,
+            "threads": threads,
+            "settings": {name: globals()[name] for name in plan_settings()},
+            "predicted_seconds": predicted,
+            "files": [plan_entry(job, probes[job.filename]) for job in jobs] + skipped,
+        }
+        with open(args.plan + ".tmp", "w") as f:
+            json.dump(saved, f, indent=1)
+        os.replace(args.plan + ".tmp", args.plan)
+        print(f"Wrote plan for {len(saved['files'])} file(s) to {args.plan}")
+    return predicted
+
+
+PLAN_VERSION = 1
+
+
+def plan_settings():
+    """Names of the config globals a saved plan carries and --execute-plan may set."""
+    return tuple(encoder_settings()) + ("PASSTHROUGH_STRATEGY", "SEGMENT_SECONDS")
+
+
+def expected_strategy(source):
+    """The pass-through strategy a run will most likely end up using for source."""
+    if PASSTHROUGH_STRATEGY != "auto":
+        return PASSTHROUGH_STRATEGY
+    directory = OUTPUT_DIR
+    while not os.path.isdir(directory):
+        directory = os.path.dirname(directory)
+    # Links and clones only work within one filesystem
+    return "hardlink" if os.stat(source).st_dev == os.stat(directory).st_dev else "copy"
+
+
+def plan_entry(job, probe, skip_reason=None):
+    """One file of a saved plan: what will be done to it, the exact ffmpeg argv and estimates."""
+    st = os.stat(os.path.join(FOLDER_PATH, job.filename))
+    entry = {
+        "file": job.filename,
+        "action": "skip" if skip_reason else job.kind,
+        "input": {"size": st.st_size, "mtime_ns": st.st_mtime_ns},
+        "input_resolution": [probe.width, probe.height],
+        "duration": probe.duration,
+        "fps": probe.fps,
+    }
+    if skip_reason:
+        entry["reason"] = skip_reason
+        return entry
+    entry["argv"] = job.cmd
+    if job.kind == "copy":
+        entry["strategy"] = expected_strategy(job.extra["source"])
+    if job.kind == "split":
+        entry["cuts"] = job.extra["cuts"]
+        entry["segments"] = len(job.extra["estimate_parts"])
+        # Cut times fix the pieces; without them the segment commands are built on execution
+        if "argv" in job.extra:
+            entry["segment_argv"] = job.extra["argv"]["segments"]
+            entry["concat_argv"] = job.extra["argv"]["concat"]
+    entry["estimated_seconds"] = job.extra["estimate"]
+    entry["estimated_output_bytes"] = estimate_output_size(job, probe)
+    return entry
+
+
+def check_plan_entry(entry):
+    """Raise ValueError unless every command of a plan entry runs ffmpeg into its place in OUTPUT_DIR."""
+    filename = entry["file"]
+    if filename in ("", ".", "..") or os.path.basename(filename) != filename:
+        raise ValueError(f"{filename!r} is not a plain file name")
+    if entry["action"] == "skip":
+        return
+    output_path = os.path.join(OUTPUT_DIR, filename)
+    if entry["action"] in ("copy", "scale"):
+        commands = [(entry["argv"], partial_path_for(output_path))]
+    elif entry["action"] == "split":
+        work_dir = segment_work_dir(output_path)
+        commands = [(entry["argv"], os.path.join(work_dir, "src_%05d.mkv"))]
+        if "segment_argv" in entry:
+            commands += [(argv, os.path.join(work_dir, f"enc_{i:05d}.mkv"))
+                         for i, argv in enumerate(entry["segment_argv"])]
+            commands.append((entry["concat_argv"], partial_path_for(output_path)))
+    else:
+        raise ValueError(f"unknown action {entry['action']!r} for {filename}")
+    for argv, output in commands:
+        if not argv or argv[0] != "ffmpeg" or argv[-1] != output:
+            raise ValueError(f"the command for {filename} does not run ffmpeg into {output}")
+
+
+def job_from_plan(entry, target, threads):
+    """Rebuild the Job for one non-skip entry of a saved plan (checked by check_plan_entry)."""
+    filename = entry["file"]
+    full_path = os.path.join(FOLDER_PATH, filename)
+    output_path = os.path.join(OUTPUT_DIR, filename)
+    kind = entry["action"]
+    if kind == "split":
+        argv = None
+        if "segment_argv" in entry:
+            argv = {"split": entry["argv"], "segments": entry["segment_argv"], "concat": entry["concat_argv"]}
+        job = build_segmented_job(filename, full_path, output_path, target, threads,
+                                  job_signature(full_path, "scale", target), duration=entry["duration"],
+                                  input_resolution=entry["input_resolution"], cuts=entry["cuts"], argv=argv)
+    else:
+        job = Job(filename, kind, entry["argv"], action=passthrough if kind == "copy" else None,
+                  output_path=output_path, partial_path=partial_path_for(output_path),
+                  signature=job_signature(full_path, kind, target))
+        job.extra["duration"] = entry["duration"]
+        job.extra["fps"] = entry["fps"]
+        if kind == "copy":
+            job.extra["source"] = full_path
+        else:
+            job.extra["target_pixels"] = target[0] * target[1]
+            job.extra["encoder"] = encoder_label()
+    job.extra["size"] = entry["input"]["size"]
+    job.extra["input_resolution"] = entry["input_resolution"]
+    job.extra["estimate"] = entry["estimated_seconds"]
+    if kind == "split":
+        job.extra["estimate_parts"] = [entry["estimated_seconds"] / entry["segments"]] * entry["segments"]
+    return job
+
+
+def execute_plan(args):
+    """Run a plan written by --plan, possibly on another machine that sees the same paths.
+
+    The plan's encoder settings replace the local ones, and each file's ffmpeg argv is
+    run exactly as planned, so a plan whose encoder cannot run here is refused, as is
+    one that sets other globals or whose commands do not write into OUTPUT_DIR. Fewer
+    jobs run if the planned -threads would oversubscribe this machine. Files whose
+    input changed since planning are skipped, as are those already done, as in run().
+    """
+    global FOLDER_PATH, OUTPUT_DIR
+    with open(args.execute_plan) as f:
+        saved = json.load(f)
+    if saved.get("version") != PLAN_VERSION:
+        print(f"{args.execute_plan} is not a version {PLAN_VERSION} plan")
+        return None
+    unknown = sorted(set(saved["settings"]) - set(plan_settings()))
+    if unknown:
+        print(f"{args.execute_plan} sets {', '.join(unknown)}, which a plan may not change")
+        return None
+    FOLDER_PATH, OUTPUT_DIR = saved["folder"], saved["output_dir"]
+    try:
+        for entry in saved["files"]:
+            check_plan_entry(entry)
+    except (KeyError, TypeError, ValueError) as e:
+        print(f"Refusing {args.execute_plan}: {e}")
+        return None
+    globals().update(saved["settings"])
+    encoder = GPU_ENCODER if USE_GPU else VIDEO_CODEC
+    profile = ffmpeg_capabilities()
+    if profile is None or encoder not in profile["encoders"]:
+        print(f"The plan encodes with {encoder}, which is not available here")
+        return None
+    if USE_GPU:
+        # The argv name the GPU encoder, so falling back as check_encoder() does is not an option
+        ok, error = encoder_works(GPU_ENCODER)
+        if not ok:
+            reason = error.splitlines()[-1] if error else "no details"
+            print(f"The plan encodes with {GPU_ENCODER}, which cannot be opened on this machine ({reason}); "
+                  f"plan again here to use {VIDEO_CODEC}")
+            return None
+    target, threads = tuple(saved["target"]), saved["threads"]
+
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    resources = effective_resources()
+    max_jobs, _ = plan_concurrency(MAX_JOBS, THREADS_PER_JOB, resources["cpus"],
+                                   memory=resources["total_memory"])
+    # The argv keep the planned -threads; keep jobs x threads within this machine's CPUs
+    max_jobs = min(max_jobs, max(1, resources["cpus"] // threads))
+    print(f"Executing plan made on {saved['host']} at "
+          f"{time.strftime('%Y-%m-%d %H:%M', time.localtime(saved['created']))} "
+          f"for {target[0]}x{target[1]}")
+    print(f"Resources: {describe_resources(resources)}")
+    print(f"Running {max_jobs} concurrent {active_encoder().name} job(s); "
+          f"the planned commands use -threads {threads} (planned for {saved['max_jobs']} job(s))")
+
+    history = History(HISTORY_PATH) if USE_HISTORY else None
+    journal = open_journal(args)
+    manifest = load_manifest(OUTPUT_DIR) if INCREMENTAL and not args.force else {}
+    jobs = []
+    changed = skipped = resumed = 0
+    for entry in saved["files"]:
+        if entry["action"] == "skip":
+            continue
+        try:
+            st = os.stat(os.path.join(FOLDER_PATH, entry["file"]))
+            unchanged = (st.st_size, st.st_mtime_ns) == (entry["input"]["size"], entry["input"]["mtime_ns"])
+            job = job_from_plan(entry, target, threads) if unchanged else None
+        except OSError:
+            unchanged = False
+        if not unchanged:
+            print(f"Skipping {entry['file']}: input changed or missing since the plan was made")
+            changed += 1
+            continue
+        if args.resume and journal.is_done(job):
+            print(f"Skipping {job.filename}: completed before the interruption")
+            manifest[job.filename] = {"signature": job.signature, "output_size": os.path.getsize(job.output_path)}
+            resumed += 1
+            continue
+        if is_up_to_date(manifest, job):
+            print(f"Skipping {job.filename}: output is up to date")
+            metrics.inc("conform_files_total", action="skipped")
+            skipped += 1
+            continue
+        jobs.append(job)
+    predicted = predict_makespan(jobs, max_jobs)
+    print(f"Predicted makespan {predicted:.1f}s ({saved['predicted_seconds']:.1f}s as planned)")
+
+    jobs, wall = execute_jobs(args, jobs, target, max_jobs, threads, resources,
+                              journal, manifest, history, predicted)
+    if skipped:
+        print(f"{skipped} file(s) skipped as up to date")
+    if resumed:
+        print(f"{resumed} file(s) already completed before the interruption")
+    if changed:
+        print(f"{changed} file(s) skipped because their input changed; plan again to include them")
+    print("Done! Check the 'output' folder for conformed files.")
+    return {"files": len(saved["files"]), "target": list(target), "encode_seconds": wall, "jobs": jobs}
+
+
+def run(args):
+    """Conform every MP4 in FOLDER_PATH (the default command)."""
+    if CHECK_ENCODER and not check_encoder():
+        return None
+    if USE_CALIBRATION and not USE_GPU:
+        apply_calibration()
+
+    found = discover(args)
+    if found is None:
+        return None
+    mp4_files, probes, cache = found["files"], found["probes"], found["cache"]
+    max_width, max_height = found["target"]
+    probe_time = found["probe_seconds"]
+
+    # 3. Create output directory
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+
+    # 4. Build one ffmpeg job per file
+    resources = effective_resources()
+    max_jobs, threads = plan_concurrency(MAX_JOBS, THREADS_PER_JOB, resources["cpus"],
+                                         memory=resources["total_memory"])
+    print(f"Resources: {describe_resources(resources)}")
+    print(f"Running {max_jobs} concurrent {active_encoder().name} job(s) with {threads} thread(s) each")
+
+    history = History(HISTORY_PATH) if USE_HISTORY else None
+    journal = open_journal(args)
+    manifest = load_manifest(OUTPUT_DIR) if INCREMENTAL and not args.force else {}
+    jobs = []
+    skipped = resumed = failed = 0
+    for filename in mp4_files:
+        job = try_build_job(filename, probes[filename], (max_width, max_height), threads, max_jobs, cache)
+        if job is None:
+            failed += 1
+            continue
+        if args.resume and journal.is_done(job):
+            print(f"Skipping {filename}: completed before the interruption")
+            manifest[filename] = {"signature": job.signature, "output_size": os.path.getsize(job.output_path)}
+            resumed += 1
+            continue
+        if is_up_to_date(manifest, job):
+            print(f"Skipping {filename}: output is up to date")
+            metrics.inc("conform_files_total", action="skipped")
+            skipped += 1
+            continue
+        w, h = probes[filename].width, probes[filename].height
+        if job.kind == "copy":
+            print(f"File {filename} matches the highest resolution ({w}x{h}). Doing pass-through (copy).")
+        elif job.kind == "split":
+            print(f"Scaling {filename} from {w}x{h} to {max_width}x{max_height} in ~{SEGMENT_SECONDS}s segments ...")
+        else:
+            print(f"Scaling {filename} from {w}x{h} to {max_width}x{max_height} ...")
+        estimate_job(job, probes[filename], threads, history)
+        jobs.append(job)
+    predicted = order_jobs(jobs, max_jobs)
+    if cache:
+        cache.close()
+
+    # 5. Run the jobs concurrently
+    jobs, wall = execute_jobs(args, jobs, (max_width, max_height), max_jobs, threads, resources,
+                              journal, manifest, history, predicted)
+    if skipped:
+        print(f"{skipped} file(s) skipped as up to date")
+    if resumed:
+        print(f"{resumed} file(s) already completed before the interruption")
+    if failed:
+        print(f"{failed} file(s) could not be probed or read and were not conformed")
+
+    print("Done! Check the 'output' folder for conformed files.")
+    return {
+        "files": len(mp4_files),
+        "target": [max_width, max_height],
+        "probe_seconds": probe_time,
+        "encode_seconds": wall,
+        "jobs": jobs,
+    }
+
+
+def open_journal(args):
+    """Open OUTPUT_DIR's journal, clearing partial outputs and, unless resuming, old states."""
+    journal = Journal(OUTPUT_DIR)
+    removed = journal.cleanup_partials()
+    if removed:
+        print(f"Removed {removed} partial output(s) left by an interrupted run")
+    if not args.resume:
+        journal.reset()
+    return journal
+
+
+def execute_jobs(args, jobs, target, max_jobs, threads, resources, journal, manifest, history, predicted):
+    """Run built jobs with journalling, manifest and history updates, then summarise them.
+
+    Closes journal and history. Returns (finished jobs, wall-clock seconds).
+    """
+    budget = MEMORY_BUDGET_MB << 20 if MEMORY_BUDGET_MB else None
+    if budget is None and resources["total_memory"]:
+        budget = int(resources["total_memory"] * 0.85)
+    memory = MemoryModel(budget, MEMORY_MODEL_PATH or os.path.join(default_cache_dir(), "memory_model.json"))
+    controller = None
+    if ADAPTIVE_CONCURRENCY or args.adaptive:
+        controller = ConcurrencyController(max_jobs, ADAPT_MAX_JOBS or resources["cpus"], ADAPT_INTERVAL)
+        print(f"Adaptive concurrency: starting at {max_jobs}, up to {controller.max_limit} job(s), "
+              f"re-evaluated every {ADAPT_INTERVAL}s")
+    journal.add_pending(jobs)
+    manifest_save = {"at": float("-inf"), "cost": 0.0}
+
+    def record(job):
+        if history:
+            history.add(job, target, threads, max_jobs)
+        if job.kind in ("split", "segment") and job.returncode == 0:
+            return  # The file is only done once its concat job succeeds
+        journal.mark_finished(job)
+        if job.returncode == 0:
+            manifest[job.filename] = {
+                "signature": job.signature,
+                "output_size": os.path.getsize(job.output_path),
+            }
+        else:
+            manifest.pop(job.filename, None)
+        # Keep finished files on disk so a killed run does not redo them. Each save rewrites
+        # the whole manifest, so once that takes noticeable time, spend at most ~10% of the run on it
+        since = time.monotonic() - manifest_save["at"]
+        if INCREMENTAL and (manifest_save["cost"] < 0.01 or since >= 10 * manifest_save["cost"]):
+            start = time.monotonic()
+            save_manifest(OUTPUT_DIR, manifest)
+            manifest_save["at"] = time.monotonic()
+            manifest_save["cost"] = manifest_save["at"] - start
+        if METRICS_TEXTFILE:
+            metrics.write_textfile(METRICS_TEXTFILE)
+
+    try:
+        jobs, wall = run_jobs(jobs, max_jobs, on_done=record, on_start=journal.mark_running,
+                              memory=memory, controller=controller)
+    finally:
+        memory.save()
+        if INCREMENTAL:
+            save_manifest(OUTPUT_DIR, manifest)
+        journal.close()
+        if history:
+            history.close()
+        if METRICS_TEXTFILE:
+            metrics.write_textfile(METRICS_TEXTFILE)
+    print_summary(jobs, wall)
+    if jobs:
+        print(f"Makespan: predicted {predicted:.1f}s, actual {wall:.1f}s")
+    if memory.summary():
+        print(f"Memory: {memory.summary()}")
+    if controller:
+        print(f"Adaptive concurrency: ran between {controller.low} and {controller.high} job(s), "
+              f"ending at {controller.limit}")
+    write_report(OUTPUT_DIR, jobs, wall, predicted)
+    return jobs, wall
+
+
+# --------------------
+# Benchmarks
+# --------------------
+# Synthetic folders for `bench`. File i gets sizes[i % len(sizes)] and cycles through durations,
+# so every scenario mixes pass-through and re-encode work. "overrides" temporarily replace config.
+BENCH_SCENARIOS = {
+    "smoke":      {"count": 10, "sizes": ["320x180", "640x360", "1280x720"], "durations": [2, 3]},
+    "mixed":      {"count": 40, "sizes": ["640x360", "1280x720", "1920x1080"], "durations": [5, 10, 20]},
+    "long":       {"count": 2, "sizes": ["1280x720", "1920x1080"], "durations": [180],
+                   "overrides": {"SEGMENT_MIN_DURATION": 60, "SEGMENT_SECONDS": 30}},
+    "tiny-100":   {"count": 100, "sizes": ["160x90", "192x108"], "durations": [0.2]},
+    "tiny-1000":  {"count": 1000, "sizes": ["160x90", "192x108"], "durations": [0.2]},
+    "tiny-10000": {"count": 10000, "sizes": ["160x90", "192x108"], "durations": [0.2]},
+}
+BENCH_FPS = 25
+
+
+def bench_clip_cmd(path, size, duration):
+    """ffmpeg command that renders one deterministic testsrc2 + sine clip."""
+    return [
+        "ffmpeg", "-y", "-nostats", "-loglevel", "error",
+        "-f", "lavfi", "-i", f"testsrc2=size={size}:rate={BENCH_FPS}:duration={duration}",
+        "-f", "lavfi", "-i", f"sine=frequency=440:sample_rate=48000:duration={duration}",
+        "-c:v", "libx264", "-preset", "ultrafast", "-g", str(BENCH_FPS * 2), "-pix_fmt", "yuv420p",
+        "-c:a", "aac", "-b:a", "96k",
+        "-fflags", "+bitexact", "-flags:v", "+bitexact", "-flags:a", "+bitexact",
+        "-shortest", path,
+    ]
+
+
+def generate_bench_folder(folder, spec):
+    """Render the clips for a scenario into folder, reusing it if it was made from the same spec."""
+    marker = os.path.join(folder, ".bench_spec.json")
+    wanted = {k: v for k, v in spec.items() if k != "overrides"}
+    try:
+        with open(marker) as f:
+            if json.load(f) == wanted:
+                return
+    except (OSError, ValueError):
+        pass
+
+    shutil.rmtree(folder, ignore_errors=True)
+    os.makedirs(folder)
+    sizes, durations = spec["sizes"], spec["durations"]
+    cmds = [
+        bench_clip_cmd(os.path.join(folder, f"clip_{i:05d}.mp4"), sizes[i % len(sizes)],
+                       durations[(i // len(sizes)) % len(durations)])
+        for i in range(spec["count"])
+    ]
+    print(f"Generating {len(cmds)} clips in {folder} ...")
+    with ThreadPoolExecutor(max_workers=available_cpus()) as pool:
+        failed = sum(1 for result in pool.map(subprocess.run, cmds) if result.returncode != 0)
+    if failed:
+        raise RuntimeError(f"{failed} benchmark clips could not be generated")
+    with open(marker, "w") as f:
+        json.dump(wanted, f)
+
+
+def source_revision():
+    """Git commit of this script, so results can be compared across commits."""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def ffmpeg_version():
+    try:
+        return subprocess.run(["ffmpeg", "-version"], capture_output=True, text=True).stdout.split("\n")[0]
+    except OSError:
+        return None
+
+
+def self_max_rss_kb():
+    """Peak RSS of this process in KB, or None where there is no resource module (Windows)."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def summarise_bench_run(stats, total):
+    """Turn run() stats into the numbers recorded by `bench`."""
+    jobs = stats["jobs"]
+    frames = sum(job.extra.get("frames") or 0 for job in jobs if job.kind in ("scale", "segment"))
+    megapixels = sum((job.extra.get("frames") or 0) * job.extra.get("target_pixels", 0)
+                     for job in jobs if job.kind in ("scale", "segment")) / 1e6
+    input_mb = sum(job.extra.get("size", 0) for job in jobs if job.kind in ("copy", "scale", "split")) / 1e6
+    child_rss = [job.extra["rusage"]["max_rss_kb"] for job in jobs if "rusage" in job.extra]
+    return {
+        "total_seconds": total,
+        "probe_seconds": stats["probe_seconds"],
+        "encode_seconds": stats["encode_seconds"],
+        "jobs": len(jobs),
+        "failed": sum(1 for job in jobs if job.returncode != 0),
+        "throughput": {
+            "files_per_second": stats["files"] / total if total else 0.0,
+            "frames_per_second": frames / stats["encode_seconds"] if stats["encode_seconds"] else 0.0,
+            "megapixels_per_second": megapixels / stats["encode_seconds"] if stats["encode_seconds"] else 0.0,
+            "input_mb_per_second": input_mb / stats["encode_seconds"] if stats["encode_seconds"] else 0.0,
+        },
+        "peak_rss_kb": {
+            "ffmpeg": max(child_rss, default=0),
+            "runner": self_max_rss_kb(),
+        },
+        "cpu_seconds_per_megapixel_frame": cpu_per_megapixel_frame(jobs),
+    }
+
+
+def bench(args):
+    """Run the full pipeline on a synthetic scenario and write the timings as JSON."""
+    global FOLDER_PATH, OUTPUT_DIR
+    spec = BENCH_SCENARIOS[args.scenario]
+    bench_dir = args.bench_dir or os.path.join(default_cache_dir(), "bench")
+    folder = os.path.join(bench_dir, args.scenario)
+    generate_bench_folder(folder, spec)
+
+    saved = {name: globals()[name] for name in ["FOLDER_PATH", "OUTPUT_DIR"] + list(spec.get("overrides", {}))}
+    globals().update(spec.get("overrides", {}))
+    FOLDER_PATH = folder
+    OUTPUT_DIR = os.path.join(bench_dir, args.scenario + "-output")
+    run_args = parse_args(["run", "--no-cache", "--force"])
+    runs = []
+    try:
+        for i in range(args.repeat):
+            shutil.rmtree(OUTPUT_DIR, ignore_errors=True)
+            start = time.perf_counter()
+            if args.verbose:
+                stats = run(run_args)
+            else:
+                with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+                    stats = run(run_args)
+            if stats is None:
+                print(f"[bench] {args.scenario} run {i + 1}/{args.repeat} stopped before running any job; "
+                      f"rerun with --verbose to see why")
+                return
+            result = summarise_bench_run(stats, time.perf_counter() - start)
+            runs.append(result)
+            print(f"[bench] {args.scenario} run {i + 1}/{args.repeat}: {result['total_seconds']:.2f}s "
+                  f"(probe {result['probe_seconds']:.2f}s, encode {result['encode_seconds']:.2f}s, "
+                  f"{result['throughput']['frames_per_second']:.0f} fps, {result['failed']} failed)")
+    finally:
+        globals().update(saved)
+
+    report = {
+        "scenario": args.scenario,
+        "spec": spec,
+        "revision": source_revision(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "host": {"cpus": available_cpus(), "platform": platform.platform(), "python": platform.python_version()},
+        "ffmpeg": ffmpeg_version(),
+        "settings": dict(encoder_settings(), MAX_JOBS=MAX_JOBS, THREADS_PER_JOB=THREADS_PER_JOB,
+                         PROBE_WORKERS=PROBE_WORKERS, PROBE_ENGINE=PROBE_ENGINE,
+                         PASSTHROUGH_STRATEGY=PASSTHROUGH_STRATEGY),
+        "median_total_seconds": statistics.median(r["total_seconds"] for r in runs),
+        "runs": runs,
+    }
+    out = args.out or f"bench-{args.scenario}.json"
+    with open(out, "w") as f:
+        json.dump(report, f, indent=1)
+    print(f"Wrote {out} (median {report['median_total_seconds']:.2f}s over {len(runs)} run(s))")
+
+
+# --------------------
+# Encoder calibration
+# --------------------
+def calibration_path():
+    return CALIBRATION_PATH or os.path.join(default_cache_dir(), "calibration.json")
+
+
+def measure_quality(encoded, source, start, seconds, target):
+    """Return (ssim, psnr) of encoded against the same stretch of source scaled to target."""
+    w, h = target
+    graph = (
+        "[0:v]setpts=PTS-STARTPTS,split[d1][d2];"
+        f"[1:v]scale={w}:{h},setpts=PTS-STARTPTS,split[r1][r2];"
+        "[d1][r1]ssim;[d2][r2]psnr"
+    )
+    cmd = [
+        "ffmpeg", "-nostats", "-hide_banner",
+        "-i", encoded,
+        "-ss", f"{start:.3f}", "-t", f"{seconds:.3f}", "-i", source,
+        "-lavfi", graph,
+        "-f", "null", "-",
+    ]
+    result = subprocess.run(cmd, capture_output=True, text=True)
+    ssim = re.search(r"SSIM .*All:([\d.]+)", result.stderr)
+    psnr = re.search(r"PSNR .*average:([\d.]+|inf)", result.stderr)
+    return (float(ssim.group(1)) if ssim else None,
+            float(psnr.group(1)) if psnr else None)
+
+
+def pareto_frontier(results, metric=None):
+    """Settings not beaten on both speed (fps) and quality by any other setting, fastest first."""
+    metric = metric or QUALITY_METRIC
+    usable = [r for r in results if r.get(metric) is not None and r["fps"]]
+    frontier = [
+        r for r in usable
+        if not any(o["fps"] >= r["fps"] and o[metric] >= r[metric]
+                   and (o["fps"] > r["fps"] or o[metric] > r[metric]) for o in usable)
+    ]
+    return sorted(frontier, key=lambda r: r["fps"], reverse=True)
+
+
+def pick_calibrated_setting(calibration, metric=None, threshold=None):
+    """Fastest frontier setting whose quality meets the threshold, or None."""
+    metric = metric or QUALITY_METRIC
+    threshold = QUALITY_THRESHOLD if threshold is None else threshold
+    for setting in pareto_frontier(calibration.get("results", []), metric):
+        if setting[metric] >= threshold:
+            return setting
+    return None
+
+
+def apply_calibration():
+    """Switch PRESET/CRF_VALUE to the calibrated choice for this machine, if there is one."""
+    global PRESET, CRF_VALUE
+    try:
+        with open(calibration_path()) as f:
+            calibration = json.load(f)
+    except (OSError, ValueError):
+        print(f"No calibration found at {calibration_path()}; keeping preset {PRESET}, CRF {CRF_VALUE}")
+        return
+    if calibration.get("codec") != VIDEO_CODEC:
+        # Presets and CRF scales mean different things to each encoder
+        print(f"Calibration was made for {calibration.get('codec')}, not {VIDEO_CODEC}; "
+              f"keeping preset {PRESET}, CRF {CRF_VALUE} (run calibrate again)")
+        return
+    if calibration.get("host", {}).get("cpus") != available_cpus():
+        print("Calibration was made on a machine with a different CPU count; speeds may not carry over")
+    setting = pick_calibrated_setting(calibration)
+    if setting is None:
+        print(f"No calibrated setting reaches {QUALITY_METRIC} >= {QUALITY_THRESHOLD}; "
+              f"keeping preset {PRESET}, CRF {CRF_VALUE}")
+        return
+    PRESET, CRF_VALUE = setting["preset"], setting["crf"]
+    print(f"Using calibrated preset {PRESET}, CRF {CRF_VALUE} "
+          f"({setting['fps']:.1f} fps, {QUALITY_METRIC} {setting[QUALITY_METRIC]:.4f})")
+
+
+def calibrate(args):
+    """Encode samples of representative inputs at each preset/CRF and record speed vs. quality."""
+    files = [f for f in os.listdir(FOLDER_PATH) if f.lower().endswith(".mp4")]
+    cache = ProbeCache(PROBE_CACHE_PATH) if USE_PROBE_CACHE and not args.no_cache else None
+    probes = {f: p for f, p in probe_files(files, FOLDER_PATH, cache, PROBE_WORKERS) if p.pixels}
+    if cache:
+        cache.close()
+    if not probes:
+        print(f"No usable MP4 files found in {FOLDER_PATH}")
+        return
+    best = max(probes.values(), key=lambda p: p.pixels)
+    target = (best.width, best.height)
+
+    # Spread the samples across the resolution range of the folder
+    ranked = sorted(probes.items(), key=lambda item: (item[1].pixels, item[0]))
+    step = max(len(ranked) / CALIBRATE_SAMPLES, 1)
+    samples = [ranked[int(i * step)] for i in range(min(CALIBRATE_SAMPLES, len(ranked)))]
+    backend = ENCODERS.get(VIDEO_CODEC) or EncoderBackend(VIDEO_CODEC, preset_flag="-preset",
+                                                          rate_control=("-crf", "{crf}"))
+    _, threads = plan_concurrency(MAX_JOBS, THREADS_PER_JOB, backend=backend)
+    print(f"Calibrating {len(CALIBRATE_PRESETS) * len(CALIBRATE_CRFS)} settings on "
+          f"{len(samples)} sample(s) at {target[0]}x{target[1]}, -threads {threads}")
+
+    results = []
+    work_dir = tempfile.mkdtemp(prefix="conform-calibrate-")
+    try:
+        for preset in CALIBRATE_PRESETS:
+            for crf in CALIBRATE_CRFS:
+                frames = wall = cpu = 0.0
+                ssim = psnr = 0.0
+                for filename, probe in samples:
+                    source = os.path.join(FOLDER_PATH, filename)
+                    seconds = min(CALIBRATE_SECONDS, probe.duration) or CALIBRATE_SECONDS
+                    start = max(probe.duration / 2 - seconds / 2, 0.0)
+                    encoded = os.path.join(work_dir, "sample.mkv")
+                    job = Job(filename, "calibrate", [
+                        "ffmpeg", "-y", "-nostats", "-loglevel", "error",
+                        "-ss", f"{start:.3f}", "-t", f"{seconds:.3f}", "-i", source,
+                        "-vf", f"scale={target[0]}:{target[1]}",
+                    ] + backend.args(preset, crf, threads) + ["-an", encoded])
+                    run_job(job, progress=BatchProgress())
+                    if job.returncode != 0:
+                        continue
+                    n = job.extra.get("frames") or 0
+                    s, p = measure_quality(encoded, source, start, seconds, target)
+                    frames += n
+                    wall += job.elapsed
+                    usage = job.extra.get("rusage", {})
+                    cpu += usage.get("user", 0.0) + usage.get("sys", 0.0)
+                    ssim += (s or 0.0) * n
+                    psnr += (p if p is not None and p != float("inf") else 100.0) * n
+                result = {
+                    "preset": preset,
+                    "crf": crf,
+                    "fps": frames / wall if wall else 0.0,
+                    "cpu_seconds_per_megapixel_frame": cpu / (frames * target[0] * target[1] / 1e6) if frames else None,
+                    "ssim": ssim / frames if frames else None,
+                    "psnr": psnr / frames if frames else None,
+                }
+                results.append(result)
+                print(f"  {preset:>9} crf {crf:>2}: {result['fps']:7.1f} fps, "
+                      f"SSIM {result['ssim'] or 0:.4f}, PSNR {result['psnr'] or 0:.2f} dB")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    calibration = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "host": {"cpus": available_cpus(), "platform": platform.platform()},
+        "ffmpeg": ffmpeg_version(),
+        "codec": VIDEO_CODEC,
+        "target": list(target),
+        "threads": threads,
+        "samples": [filename for filename, _ in samples],
+        "results": results,
+        "frontier": pareto_frontier(results),
+    }
+    path = calibration_path()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(calibration, f, indent=1)
+
+    print(f"Pareto frontier ({QUALITY_METRIC}), fastest first:")
+    for r in calibration["frontier"]:
+        print(f"  {r['preset']:>9} crf {r['crf']:>2}: {r['fps']:7.1f} fps, {QUALITY_METRIC} {r[QUALITY_METRIC]:.4f}")
+    choice = pick_calibrated_setting(calibration)
+    if choice:
+        print(f"Fastest setting with {QUALITY_METRIC} >= {QUALITY_THRESHOLD}: "
+              f"preset {choice['preset']}, CRF {choice['crf']}. Set USE_CALIBRATION = True to use it.")
+    else:
+        print(f"No setting reached {QUALITY_METRIC} >= {QUALITY_THRESHOLD}")
+    print(f"Wrote {path}")
+
+
+# Stand-ins for ffprobe/ffmpeg used by `bench-overhead`. Plain sh keeps each spawn as cheap as
+# possible so the numbers measure this script, not the stubs. "*_hi.mp4" files are 1080p, the rest
+# 720p, so half the folder passes through and half is "scaled".
+FAKE_FFPROBE = """#!/bin/sh
+[ -n "$FAKE_PROBE_SLEEP" ] && sleep "$FAKE_PROBE_SLEEP"
+for last; do :; done
+case "$last" in *_hi.mp4) W=1920 H=1080;; *) W=1280 H=720;; esac
+printf '{"streams":[{"index":0,"codec_type":"video","codec_name":"h264","width":%s,"height":%s,\
+"pix_fmt":"yuv420p","avg_frame_rate":"25/1","duration":"10.0"},{"index":1,"codec_type":"audio",\
+"codec_name":"aac","channels":2,"sample_rate":"48000"}],"format":{"duration":"10.0","bit_rate":"1000000"}}\n' $W $H
+"""
+FAKE_FFMPEG = """#!/bin/sh
+case "$*" in
+    -version) echo "ffmpeg version fake"; exit 0;;
+    *-encoders) printf ' ------\\n V....D libx264 fake H.264\\n A....D aac fake AAC\\n'; exit 0;;
+    *-filters) printf ' ... scale V->V fake scale\\n'; exit 0;;
+    *-hwaccels) printf 'Hardware acceleration methods:\\n'; exit 0;;
+esac
+[ -n "$FAKE_ENCODE_SLEEP" ] && sleep "$FAKE_ENCODE_SLEEP"
+for last; do :; done
+: > "$last"
+case " $* " in *" -progress pipe:1 "*) printf 'frame=250\nfps=250\nout_time_us=10000000\nspeed=10x\nprogress=end\n';; esac
+"""
+
+
+def install_fake_tools(folder):
+    """Write the ffprobe/ffmpeg stubs into folder and return it."""
+    os.makedirs(folder, exist_ok=True)
+    for name, body in (("ffprobe", FAKE_FFPROBE), ("ffmpeg", FAKE_FFMPEG)):
+        path = os.path.join(folder, name)
+        with open(path, "w") as f:
+            f.write(body)
+        os.chmod(path, 0o755)
+    return folder
+
+
+def bench_overhead(args):
+    """Measure orchestration overhead (probing, planning, spawning, bookkeeping) with stub tools.
+
+    Drives run() over args.files empty files with fake ffprobe/ffmpeg on PATH that only sleep
+    for --probe-sleep / --encode-sleep seconds, so no real media or encoder is needed.
+    """
+    global FOLDER_PATH, OUTPUT_DIR, USE_HISTORY, MEMORY_MODEL_PATH
+    bench_dir = args.bench_dir or os.path.join(default_cache_dir(), "bench")
+    folder = os.path.join(bench_dir, f"overhead-{args.files}")
+    if len([f for f in os.listdir(folder) if f.endswith(".mp4")] if os.path.isdir(folder) else []) != args.files:
+        shutil.rmtree(folder, ignore_errors=True)
+        os.makedirs(folder)
+        print(f"Creating {args.files} empty files in {folder} ...")
+        for i in range(args.files):
+            open(os.path.join(folder, f"clip_{i:06d}_{'hi' if i % 2 == 0 else 'lo'}.mp4"), "w").close()
+    tools = install_fake_tools(os.path.join(bench_dir, "fake-tools"))
+
+    saved = {"FOLDER_PATH": FOLDER_PATH, "OUTPUT_DIR": OUTPUT_DIR,
+             "USE_HISTORY": USE_HISTORY, "MEMORY_MODEL_PATH": MEMORY_MODEL_PATH}
+    saved_env = {k: os.environ.get(k) for k in ("PATH", "FAKE_PROBE_SLEEP", "FAKE_ENCODE_SLEEP")}
+    FOLDER_PATH = folder
+    OUTPUT_DIR = os.path.join(bench_dir, f"overhead-{args.files}-output")
+    # Stub timings and memory use would only skew what real runs learn
+    USE_HISTORY = False
+    MEMORY_MODEL_PATH = os.path.join(bench_dir, "fake-tools", "memory_model.json")
+    os.environ["PATH"] = tools + os.pathsep + os.environ.get("PATH", "")
+    for key, value in (("FAKE_PROBE_SLEEP", args.probe_sleep), ("FAKE_ENCODE_SLEEP", args.encode_sleep)):
+        if value:
+            os.environ[key] = str(value)
+        else:
+            os.environ.pop(key, None)
+
+    shutil.rmtree(OUTPUT_DIR, ignore_errors=True)
+    rss_before = self_max_rss_kb()
+    start = time.perf_counter()
+    try:
+        if args.verbose:
+            stats = run(parse_args(["run", "--no-cache", "--force"]))
+        else:
+            with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+                stats = run(parse_args(["run", "--no-cache", "--force"]))
+    finally:
+        total = time.perf_counter() - start
+        globals().update(saved)
+        for key, value in saved_env.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+    rss_after = self_max_rss_kb()
+    if stats is None:
+        print("[bench-overhead] the run stopped before running any job; rerun with --verbose to see why")
+        return
+
+    jobs = stats["jobs"]
+    max_jobs, _ = plan_concurrency(MAX_JOBS, THREADS_PER_JOB)
+    ffmpeg_spawns = sum(1 for job in jobs if job.action is None or job.extra.get("strategy") == "remux")
+    spawns = stats["files"] + ffmpeg_spawns  # Stub files never parse as MP4, so each is ffprobed
+    ideal = ffmpeg_spawns * args.encode_sleep / max_jobs
+    result = {
+        "files": stats["files"],
+        "jobs": len(jobs),
+        "max_jobs": max_jobs,
+        "probe_sleep": args.probe_sleep,
+        "encode_sleep": args.encode_sleep,
+        "total_seconds": total,
+        "probe_seconds": stats["probe_seconds"],
+        "encode_seconds": stats["encode_seconds"],
+        "spawns": spawns,
+        "spawns_per_second": spawns / total if total else 0.0,
+        "files_per_second": stats["files"] / total if total else 0.0,
+        "scheduler_overhead_ms_per_job": (stats["encode_seconds"] - ideal) / max(len(jobs), 1) * 1000,
+        "rss_growth_bytes_per_file": (rss_after - rss_before) * 1024 / max(stats["files"], 1)
+                                     if rss_after is not None else None,
+        "peak_rss_kb": rss_after,
+        "revision": source_revision(),
+    }
+    print(f"[bench-overhead] {result['files']} files in {total:.1f}s: {result['files_per_second']:.0f} files/s, "
+          f"{result['spawns_per_second']:.0f} spawns/s, "
+          f"{result['scheduler_overhead_ms_per_job']:.2f} ms scheduler overhead per job"
+          + (f", {result['rss_growth_bytes_per_file']:.0f} B RSS per file" if rss_after is not None else ""))
+    out = args.out or "bench-overhead.json"
+    with open(out, "w") as f:
+        json.dump(result, f, indent=1)
+    print(f"Wrote {out}")
+
+@dataclass
+class ProbeResult:
+    """Metadata of one input file, gathered from a single ffprobe call."""
+    width: int = 0
+    height: int = 0
+    codec: str = None
+    pix_fmt: str = None
+    fps: float = 0.0
+    duration: float = 0.0
+    bitrate: int = 0
+    rotation: int = 0
+    audio_streams: list = field(default_factory=list)
+
+    @property
+    def pixels(self):
+        return self.width * self.height
+
+
+def parse_rate(value):
+    """Turn an ffprobe rate such as "30000/1001" into a float."""
+    try:
+        num, _, den = str(value).partition("/")
+        return float(num) / float(den or 1)
+    except (ValueError, ZeroDivisionError):
+        return 0.0
+
+
+def parse_probe(data):
+    """Build a ProbeResult from ffprobe's -show_streams -show_format JSON."""
+    streams = data.get("streams", [])
+    fmt = data.get("format", {})
+    video = next((s for s in streams if s.get("codec_type") == "video"), None)
+    if video is None:
+        raise ValueError("no video stream")
+
+    rotation = 0
+    for side_data in video.get("side_data_list", []):
+        if "rotation" in side_data:
+            rotation = int(side_data["rotation"])
+    if not rotation and "rotate" in video.get("tags", {}):
+        rotation = int(video["tags"]["rotate"])
+
+    return ProbeResult(
+        width=int(video["width"]),
+        height=int(video["height"]),
+        codec=video.get("codec_name"),
+        pix_fmt=video.get("pix_fmt"),
+        fps=parse_rate(video.get("avg_frame_rate") or video.get("r_frame_rate")),
+        duration=float(video.get("duration") or fmt.get("duration") or 0),
+        bitrate=int(fmt.get("bit_rate") or video.get("bit_rate") or 0),
+        rotation=rotation,
+        audio_streams=[
+            {
+                "index": s.get("index"),
+                "codec": s.get("codec_name"),
+                "channels": s.get("channels"),
+                "sample_rate": int(s.get("sample_rate") or 0),
+            }
+            for s in streams if s.get("codec_type") == "audio"
+        ],
+    )
+
+
+# --------------------
+# MP4/MOV header parsing
+# --------------------
+MP4_EXTENSIONS = (".mp4", ".m4v", ".mov")
+MP4_MAX_MOOV   = 256 * 1024 * 1024  # Refuse to load absurd moov boxes; ffprobe will handle those
+MP4_CODECS = {
+    "avc1": "h264", "avc3": "h264", "hvc1": "hevc", "hev1": "hevc", "av01": "av1",
+    "vp09": "vp9", "mp4v": "mpeg4", "apch": "prores", "apcn": "prores", "apcs": "prores",
+    "apco": "prores", "ap4h": "prores", "mp4a": "aac", "ac-3": "ac3", "ec-3": "eac3",
+    "Opus": "opus", "fLaC": "flac", "alac": "alac", "sowt": "pcm_s16le", "twos": "pcm_s16be",
+}
+
+
+class Mp4ParseError(Exception):
+    """Raised when the in-process MP4 parser cannot handle a file."""
+
+
+# Everything the header parser may raise on a file it cannot read; callers fall back to ffprobe.
+# Malformed boxes can also surface as a short read (struct.error) or an index past the buffer.
+MP4_ERRORS = (Mp4ParseError, OSError, struct.error, IndexError, ValueError)
+
+
+def iter_boxes(data, start=0, end=None):
+    """Yield (type, payload_start, payload_end) for each box in data[start:end]."""
+    end = len(data) if end is None else end
+    pos = start
+    while pos + 8 <= end:
+        size, box_type = struct.unpack_from(">I4s", data, pos)
+        header = 8
+        if size == 1:
+            if pos + 16 > end:
+                raise Mp4ParseError("truncated 64-bit box header")
+            size = struct.unpack_from(">Q", data, pos + 8)[0]
+            header = 16
+        elif size == 0:
+            size = end - pos
+        if size < header or pos + size > end:
+            raise Mp4ParseError(f"bad size for {box_type!r} box")
+        yield box_type.decode("latin-1"), pos + header, pos + size
+        pos += size
+
+
+def find_box(data, start, end, *path):
+    """Return (payload_start, payload_end) of the box at path below data[start:end], or None."""
+    for name in path:
+        for box_type, box_start, box_end in iter_boxes(data, start, end):
+            if box_type == name:
+                start, end = box_start, box_end
+                break
+        else:
+            return None
+    return start, end
+
+
+def read_moov(f, file_size):
+    """Read the top-level moov box, seeking past mdat wherever it sits in the file."""
+    pos = 0
+    while pos + 8 <= file_size:
+        f.seek(pos)
+        header = f.read(16)
+        if len(header) < 8:
+            break
+        size, box_type = struct.unpack_from(">I4s", header)
+        header_size = 8
+        if size == 1:
+            if len(header) < 16:
+                break
+            size = struct.unpack_from(">Q", header, 8)[0]
+            header_size = 16
+        elif size == 0:
+            size = file_size - pos
+        if size < header_size:
+            raise Mp4ParseError(f"bad size for top-level {box_type!r} box")
+        if box_type == b"moov":
+            if size > MP4_MAX_MOOV:
+                raise Mp4ParseError("moov box too large")
+            f.seek(pos + header_size)
+            data = f.read(size - header_size)
+            if len(data) != size - header_size:
+                raise Mp4ParseError("truncated moov box")
+            return data
+        pos += size
+    raise Mp4ParseError("no moov box")
+
+
+MP4_CHROMA_FORMATS = {0: "gray", 1: "yuv420p", 2: "yuv422p", 3: "yuv444p"}
+
+
+def mp4_pix_fmt(data, start, end):
+    """Return the ffmpeg pix_fmt described by the avcC/hvcC/vpcC/av1C box in data[start:end], or None.
+
+    Other codecs (ProRes, MPEG-4 Part 2, ...) do not carry it in a fixed place; their
+    ProbeResult has pix_fmt None, as does an ffprobe result without the field.
+    """
+    try:
+        boxes = list(iter_boxes(data, start, end))
+    except Mp4ParseError:
+        return None  # Padding some writers leave after the fixed fields; the rest of the probe is fine
+    for box_type, box_start, box_end in boxes:
+        config = data[box_start:box_end]
+        if box_type == "avcC" and len(config) >= 4:
+            chroma, depth = 1, 8
+            if config[1] not in (66, 77, 88) and len(config) >= 7:
+                # High profiles append chroma_format and bit depths after the parameter sets
+                pos = 6
+                for count_mask in (0x1F, 0xFF):
+                    count = config[pos - 1] & count_mask
+                    for _ in range(count):
+                        pos += 2 + int.from_bytes(config[pos:pos + 2], "big")
+                    pos += 1
+                if pos + 1 < len(config):
+                    chroma, depth = config[pos - 1] & 0x03, (config[pos] & 0x07) + 8
+        elif box_type == "hvcC" and len(config) >= 18:
+            chroma, depth = config[16] & 0x03, (config[17] & 0x07) + 8
+        elif box_type == "vpcC" and len(config) >= 7:
+            chroma = {0: 1, 1: 1, 2: 2, 3: 3}.get((config[6] >> 1) & 0x07)
+            depth = config[6] >> 4
+        elif box_type == "av1C" and len(config) >= 3:
+            depth = 12 if config[2] & 0x20 else 10 if config[2] & 0x40 else 8
+            if config[2] & 0x10:
+                chroma = 0
+            else:
+                chroma = {(1, 1): 1, (1, 0): 2, (0, 0): 3}.get(((config[2] >> 3) & 1, (config[2] >> 2) & 1))
+        else:
+            continue
+        base = MP4_CHROMA_FORMATS.get(chroma)
+        if base is None or depth not in (8, 10, 12):
+            return None
+        return base if depth == 8 else f"{base}{depth}le"
+    return None
+
+
+def parse_mp4_track(moov, start, end):
+    """Extract handler, codec, dimensions, timing and rotation from one trak box."""
+    track = {"handler": None, "codec": None, "width": 0, "height": 0, "rotation": 0, "pix_fmt": None,
+             "timescale": 0, "duration": 0, "samples": 0, "channels": None, "sample_rate": 0}
+
+    tkhd = find_box(moov, start, end, "tkhd")
+    if tkhd:
+        version = moov[tkhd[0]]
+        matrix = tkhd[0] + (52 if version == 1 else 40)
+        a, b = struct.unpack_from(">ii", moov, matrix)
+        if a or b:
+            track["rotation"] = round(-math.degrees(math.atan2(b / 65536, a / 65536)))
+
+    mdia = find_box(moov, start, end, "mdia")
+    if not mdia:
+        raise Mp4ParseError("trak without mdia")
+    hdlr = find_box(moov, mdia[0], mdia[1], "hdlr")
+    if hdlr:
+        track["handler"] = moov[hdlr[0] + 8:hdlr[0] + 12].decode("latin-1")
+    mdhd = find_box(moov, mdia[0], mdia[1], "mdhd")
+    if mdhd:
+        if moov[mdhd[0]] == 1:
+            track["timescale"], track["duration"] = struct.unpack_from(">IQ", moov, mdhd[0] + 20)
+        else:
+            track["timescale"], track["duration"] = struct.unpack_from(">II", moov, mdhd[0] + 12)
+
+    stbl = find_box(moov, mdia[0], mdia[1], "minf", "stbl")
+    if not stbl:
+        return track
+    stts = find_box(moov, stbl[0], stbl[1], "stts")
+    if stts:
+        (count,) = struct.unpack_from(">I", moov, stts[0] + 4)
+        track["samples"] = sum(
+            struct.unpack_from(">I", moov, stts[0] + 8 + 8 * i)[0] for i in range(count)
+        )
+    stsd = find_box(moov, stbl[0], stbl[1], "stsd")
+    if stsd:
+        for entry_type, entry_start, entry_end in iter_boxes(moov, stsd[0] + 8, stsd[1]):
+            track["codec"] = MP4_CODECS.get(entry_type, entry_type.strip())
+            if track["handler"] == "vide" and entry_end - entry_start >= 28:
+                track["width"], track["height"] = struct.unpack_from(">HH", moov, entry_start + 24)
+                # Codec configuration boxes follow the 78 bytes of VisualSampleEntry fields
+                track["pix_fmt"] = mp4_pix_fmt(moov, entry_start + 78, entry_end)
+            elif track["handler"] == "soun" and entry_end - entry_start >= 26:
+                track["channels"] = struct.unpack_from(">H", moov, entry_start + 16)[0]
+                track["sample_rate"] = struct.unpack_from(">H", moov, entry_start + 24)[0]
+            break
+    return track
+
+
+def probe_mp4(file_path):
+    """Build a ProbeResult from MP4/MOV headers without spawning ffprobe.
+
+    Raises Mp4ParseError (or OSError) if the file is not something this parser understands.
+    """
+    with open(file_path, "rb") as f:
+        file_size = os.fstat(f.fileno()).st_size
+        moov = read_moov(f, file_size)
+
+    tracks = [parse_mp4_track(moov, s, e) for t, s, e in iter_boxes(moov) if t == "trak"]
+    video = next((t for t in tracks if t["handler"] == "vide" and t["width"]), None)
+    if video is None or not video["timescale"]:
+        raise Mp4ParseError("no usable video track")
+    if not video["duration"] or not video["samples"]:
+        raise Mp4ParseError("fragmented file: samples live in moof boxes")
+
+    duration = video["duration"] / video["timescale"]
+    mvhd = find_box(moov, 0, len(moov), "mvhd")
+    format_duration = duration
+    if mvhd:
+        if moov[mvhd[0]] == 1:
+            timescale, total = struct.unpack_from(">IQ", moov, mvhd[0] + 20)
+        else:
+            timescale, total = struct.unpack_from(">II", moov, mvhd[0] + 12)
+        if timescale and total:
+            format_duration = total / timescale
+
+    return ProbeResult(
+        width=video["width"],
+        height=video["height"],
+        codec=video["codec"],
+        pix_fmt=video["pix_fmt"],
+        fps=video["samples"] / duration if duration else 0.0,
+        duration=duration,
+        bitrate=int(file_size * 8 / format_duration) if format_duration else 0,
+        rotation=video["rotation"],
+        audio_streams=[
+            {"index": i, "codec": t["codec"], "channels": t["channels"], "sample_rate": t["sample_rate"]}
+            for i, t in enumerate(tracks) if t["handler"] == "soun"
+        ],
+    )
+
+
+def mp4_keyframes(file_path):
+    """Return video keyframe decode times (seconds) from the MP4 stss/stts sample tables.
+
+    Raises Mp4ParseError if the file has no usable sample tables.
+    """
+    with open(file_path, "rb") as f:
+        moov = read_moov(f, os.fstat(f.fileno()).st_size)
+
+    for box_type, start, end in iter_boxes(moov):
+        if box_type != "trak":
+            continue
+        mdia = find_box(moov, start, end, "mdia")
+        hdlr = mdia and find_box(moov, mdia[0], mdia[1], "hdlr")
+        if not hdlr or moov[hdlr[0] + 8:hdlr[0] + 12] != b"vide":
+            continue
+        timescale = parse_mp4_track(moov, start, end)["timescale"]
+        stbl = find_box(moov, mdia[0], mdia[1], "minf", "stbl")
+        stts = stbl and find_box(moov, stbl[0], stbl[1], "stts")
+        if not timescale or not stts:
+            raise Mp4ParseError("video track without timing")
+
+        # Decode time of every sample, expanded from stts run lengths
+        times = []
+        t = 0
+        (count,) = struct.unpack_from(">I", moov, stts[0] + 4)
+        for i in range(count):
+            run, delta = struct.unpack_from(">II", moov, stts[0] + 8 + 8 * i)
+            for _ in range(run):
+                times.append(t / timescale)
+                t += delta
+        if not times:
+            raise Mp4ParseError("fragmented file: samples live in moof boxes")
+
+        stss = find_box(moov, stbl[0], stbl[1], "stss")
+        if stss is None:
+            return times  # No sync sample table: every sample is a keyframe
+        (count,) = struct.unpack_from(">I", moov, stss[0] + 4)
+        samples = struct.unpack_from(f">{count}I", moov, stss[0] + 8)
+        return [times[n - 1] for n in samples if 0 < n <= len(times)]
+    raise Mp4ParseError("no video track")
+
+
+def ffprobe_keyframes(file_path):
+    """Return video keyframe timestamps (seconds) from a packet-level ffprobe scan, or None."""
+    cmd = [
+        "ffprobe",
+        "-v", "error",
+        "-select_streams", "v:0",
+        "-show_entries", "packet=pts_time,flags",
+        "-of", "csv=p=0",
+        file_path
+    ]
+    result = subprocess.run(cmd, capture_output=True, text=True)
+    if result.returncode != 0:
+        print(f"FFprobe error on {file_path}: {result.stderr}")
+        return None
+    times = []
+    for line in result.stdout.splitlines():
+        pts_time, _, flags = line.partition(",")
+        if "K" in flags and pts_time not in ("", "N/A"):
+            times.append(float(pts_time))
+    return sorted(times)
+
+
+def keyframe_index(file_path, cache=None, engine=None):
+    """Return keyframe timestamps for file_path, reading the sample tables in-process when possible.
+
+    Results are stored in the probe cache, so planning a file's segments again is free.
+    """
+    if cache:
+        cached = cache.get_keyframes(file_path)
+        if cached is not None:
+            return cached
+    keyframes = None
+    if (engine or PROBE_ENGINE) == "auto" and file_path.lower().endswith(MP4_EXTENSIONS):
+        try:
+            keyframes = mp4_keyframes(file_path)
+        except MP4_ERRORS:
+            pass
+    if keyframes is None:
+        keyframes = ffprobe_keyframes(file_path)
+    if cache and keyframes:
+        cache.put_keyframes(file_path, keyframes)
+    return keyframes
+
+
+def plan_segment_times(keyframes, duration, segment_seconds=None):
+    """Pick keyframes roughly segment_seconds apart to cut at, never leaving a short last piece."""
+    segment_seconds = segment_seconds or SEGMENT_SECONDS
+    cuts = []
+    last = 0.0
+    for t in keyframes:
+        if t - last >= segment_seconds and duration - t >= segment_seconds / 2:
+            cuts.append(t)
+            last = t
+    return cuts
+
+
+def ffprobe_video(file_path):
+    """Return a ProbeResult for file_path using ffprobe, or None if it cannot be probed."""
+    cmd = [
+        "ffprobe",
+        "-v", "error",
+        "-show_streams",
+        "-show_format",
+        "-of", "json",
+        file_path
+    ]
+    result = subprocess.run(cmd, capture_output=True, text=True)
+    if result.returncode != 0:
+        print(f"FFprobe error on {file_path}: {result.stderr}")
+        return None
+
+    try:
+        return parse_probe(json.loads(result.stdout))
+    except Exception as e:
+        print(f"Error parsing probe output for {file_path}: {e}")
+        return None
+
+
+def probe_video(file_path, engine=None):
+    """Return a ProbeResult for file_path, or None if it cannot be probed.
+
+    With the "auto" engine, MP4/MOV files are read in-process and only fall back to
+    ffprobe when the header parser gives up.
+    """
+    with tracer.span("probe", "probe", file=os.path.basename(file_path)):
+        return _probe_video(file_path, engine)
+
+
+def _probe_video(file_path, engine=None):
+    engine = engine or PROBE_ENGINE
+    start = time.perf_counter()
+    if engine == "auto" and file_path.lower().endswith(MP4_EXTENSIONS):
+        try:
+            probe = probe_mp4(file_path)
+            metrics.inc("conform_files_probed_total", source="mp4")
+            metrics.observe("conform_probe_seconds", time.perf_counter() - start, engine="mp4")
+            return probe
+        except MP4_ERRORS:
+            pass
+    probe = ffprobe_video(file_path)
+    metrics.inc("conform_files_probed_total", source="ffprobe")
+    metrics.observe("conform_probe_seconds", time.perf_counter() - start, engine="ffprobe")
+    return probe
+
+
+def bench_probe(folder, repeat=1):
+    """Compare the in-process MP4 parser against ffprobe on every MP4/MOV file in folder."""
+    paths = [os.path.join(folder, f) for f in sorted(os.listdir(folder))
+             if f.lower().endswith(MP4_EXTENSIONS)] * repeat
+    if not paths:
+        print(f"No MP4/MOV files found in {folder}")
+        return
+
+    start = time.perf_counter()
+    reference = [ffprobe_video(p) for p in paths]
+    ffprobe_time = time.perf_counter() - start
+
+    fallbacks = 0
+    start = time.perf_counter()
+    fast = []
+    for p in paths:
+        try:
+            fast.append(probe_mp4(p))
+        except MP4_ERRORS:
+            fast.append(None)
+            fallbacks += 1
+    fast_time = time.perf_counter() - start
+
+    mismatches = [
+        p for p, ref, got in zip(paths, reference, fast)
+        if ref and got and (ref.width, ref.height) != (got.width, got.height)
+    ]
+    n = len(paths)
+    print(f"ffprobe:    {n} files in {ffprobe_time:.2f}s ({n / ffprobe_time:.0f} files/s)")
+    print(f"mp4 parser: {n} files in {fast_time:.2f}s ({n / max(fast_time, 1e-9):.0f} files/s), "
+          f"{fallbacks} would fall back to ffprobe")
+    print(f"Speedup {ffprobe_time / max(fast_time, 1e-9):.1f}x, {len(mismatches)} resolution mismatch(es)")
+    for p in mismatches:
+        print(f"  mismatch: {p}")
+
+
+def probe_all(filenames, folder, workers=PROBE_WORKERS):
+    """Probe files concurrently, yielding (filename, ProbeResult) as each finishes."""
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="probe") as pool:
+        futures = {
+            pool.submit(probe_video, os.path.join(folder, filename)): filename
+            for filename in filenames
+        }
+        for future in as_completed(futures):
+            yield futures[future], future.result() or ProbeResult()
+
+
+def probe_files(filenames, folder, cache=None, workers=PROBE_WORKERS):
+    """Yield (filename, ProbeResult) for every file, serving unchanged files from the cache."""
+    to_probe = []
+    for filename in filenames:
+        cached = cache.get(os.path.join(folder, filename)) if cache else None
+        if cached is None:
+            to_probe.append(filename)
+        else:
+            metrics.inc("conform_files_probed_total", source="cache")
+            yield filename, cached
+
+    for filename, probe in probe_all(to_probe, folder, workers):
+        if cache and probe.pixels:
+            cache.put(os.path.join(folder, filename), probe)
+        yield filename, probe
+
+
+def default_cache_dir():
+    """Per-user cache directory for conformvids."""
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "conformvids")
+
+
+def file_fingerprint(file_path):
+    """Return (absolute path, size, mtime_ns, inode) identifying the current contents of a file."""
+    st = os.stat(file_path)
+    return (os.path.abspath(file_path), st.st_size, st.st_mtime_ns, st.st_ino)
+
+
+class ProbeCache:
+    """SQLite store of ProbeResults, valid while a file's size, mtime and inode are unchanged."""
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(default_cache_dir(), "probe_cache.sqlite")
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.db = sqlite3.connect(self.path)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS probes ("
+            " path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, inode INTEGER, data TEXT)"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS keyframes ("
+            " path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, inode INTEGER, times TEXT)"
+        )
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, file_path):
+        """Return the cached ProbeResult for file_path, or None if missing or stale."""
+        try:
+            path, size, mtime_ns, inode = file_fingerprint(file_path)
+        except OSError:
+            self.misses += 1
+            return None
+        row = self.db.execute(
+            "SELECT data FROM probes WHERE path = ? AND size = ? AND mtime_ns = ? AND inode = ?",
+            (path, size, mtime_ns, inode),
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return ProbeResult(**json.loads(row[0]))
+
+    def put(self, file_path, probe):
+        try:
+            path, size, mtime_ns, inode = file_fingerprint(file_path)
+        except OSError:
+            return
+        self.db.execute(
+            "INSERT OR REPLACE INTO probes (path, size, mtime_ns, inode, data) VALUES (?, ?, ?, ?, ?)",
+            (path, size, mtime_ns, inode, json.dumps(asdict(probe))),
+        )
+
+    def get_keyframes(self, file_path):
+        """Return cached keyframe timestamps for file_path, or None if missing or stale."""
+        try:
+            path, size, mtime_ns, inode = file_fingerprint(file_path)
+        except OSError:
+            return None
+        row = self.db.execute(
+            "SELECT times FROM keyframes WHERE path = ? AND size = ? AND mtime_ns = ? AND inode = ?",
+            (path, size, mtime_ns, inode),
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put_keyframes(self, file_path, times):
+        try:
+            path, size, mtime_ns, inode = file_fingerprint(file_path)
+        except OSError:
+            return
+        self.db.execute(
+            "INSERT OR REPLACE INTO keyframes (path, size, mtime_ns, inode, times) VALUES (?, ?, ?, ?, ?)",
+            (path, size, mtime_ns, inode, json.dumps(times)),
+        )
+
+    def prune(self):
+        """Delete entries whose file is gone or has changed. Returns the number removed."""
+        removed = 0
+        for table in ("probes", "keyframes"):
+            stale = []
+            for path, size, mtime_ns, inode in self.db.execute(
+                f"SELECT path, size, mtime_ns, inode FROM {table}"
+            ).fetchall():
+                try:
+                    if file_fingerprint(path) != (path, size, mtime_ns, inode):
+                        stale.append(path)
+                except OSError:
+                    stale.append(path)
+            self.db.executemany(f"DELETE FROM {table} WHERE path = ?", [(p,) for p in stale])
+            removed += len(stale)
+        self.db.commit()
+        self.db.execute("VACUUM")
+        return removed
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
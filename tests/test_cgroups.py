@@ -0,0 +1,89 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import conformvids
+
+
+class CgroupTest(unittest.TestCase):
+    """cgroup_dirs() and cgroup_limits() against a fake /proc/self/cgroup and cgroup tree."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = os.path.join(self.tmp.name, "cgroup")
+        self.proc = os.path.join(self.tmp.name, "proc_cgroup")
+        self.saved = conformvids.CGROUP_ROOT, conformvids.PROC_CGROUP
+        conformvids.CGROUP_ROOT, conformvids.PROC_CGROUP = self.root, self.proc
+
+    def tearDown(self):
+        conformvids.CGROUP_ROOT, conformvids.PROC_CGROUP = self.saved
+        self.tmp.cleanup()
+
+    def write(self, path, text):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(text)
+
+    def v2_tree(self, proc_line):
+        self.write(os.path.join(self.root, "cgroup.controllers"), "cpu memory cpuset\n")
+        self.write(self.proc, proc_line + "\n")
+
+    def test_v2_walks_from_own_cgroup_up_to_root(self):
+        self.v2_tree("0::/jobs/conform")
+        inner = os.path.join(self.root, "jobs", "conform")
+        self.write(os.path.join(inner, "cpu.max"), "400000 100000\n")
+        self.write(os.path.join(self.root, "jobs", "memory.max"), "4294967296\n")
+        self.write(os.path.join(self.root, "jobs", "cpu.max"), "max 100000\n")
+        self.write(os.path.join(self.root, "cpuset.cpus.effective"), "0-3,8,10-11\n")
+
+        self.assertEqual(conformvids.cgroup_dirs(), [
+            (2, inner), (2, os.path.join(self.root, "jobs")), (2, self.root),
+        ])
+        self.assertEqual(conformvids.cgroup_limits(), {
+            "cpu_quota": 4.0, "cpuset": 7, "memory": 4294967296, "version": 2,
+        })
+
+    def test_tightest_limit_along_the_hierarchy_wins(self):
+        self.v2_tree("0::/a/b")
+        self.write(os.path.join(self.root, "a", "b", "cpu.max"), "800000 100000\n")
+        self.write(os.path.join(self.root, "a", "cpu.max"), "250000 100000\n")
+        self.assertEqual(conformvids.cgroup_limits()["cpu_quota"], 2.5)
+
+    def test_paths_outside_the_mount_fall_back_to_root(self):
+        for path in ("/..", "/../../x", "/missing/cgroup"):
+            with self.subTest(path=path):
+                self.v2_tree(f"0::{path}")
+                self.assertEqual(conformvids.cgroup_dirs(), [(2, self.root)])
+
+    def test_v1_hierarchies(self):
+        self.write(self.proc, "12:cpu,cpuacct:/docker/abc\n11:memory:/docker/abc\n1:name=systemd:/\n")
+        cpu = os.path.join(self.root, "cpu,cpuacct", "docker", "abc")
+        self.write(os.path.join(cpu, "cpu.cfs_quota_us"), "150000\n")
+        self.write(os.path.join(cpu, "cpu.cfs_period_us"), "100000\n")
+        self.write(os.path.join(self.root, "cpu,cpuacct", "cpu.cfs_quota_us"), "-1\n")
+        self.write(os.path.join(self.root, "cpu,cpuacct", "cpu.cfs_period_us"), "100000\n")
+        memory = os.path.join(self.root, "memory", "docker", "abc")
+        self.write(os.path.join(memory, "memory.limit_in_bytes"), "2147483648\n")
+        self.write(os.path.join(self.root, "memory", "memory.limit_in_bytes"), "9223372036854771712\n")
+
+        self.assertEqual(conformvids.cgroup_limits(), {
+            "cpu_quota": 1.5, "cpuset": None, "memory": 2147483648, "version": 1,
+        })
+
+    def test_no_limits(self):
+        self.v2_tree("0::/")
+        self.write(os.path.join(self.root, "cpu.max"), "max 100000\n")
+        self.write(os.path.join(self.root, "memory.max"), "max\n")
+        self.assertEqual(conformvids.cgroup_limits(), {
+            "cpu_quota": None, "cpuset": None, "memory": None, "version": None,
+        })
+
+    def test_missing_proc_file(self):
+        self.assertEqual(conformvids.cgroup_dirs(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,192 @@
+import os
+import struct
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import conformvids
+
+
+def box(box_type, *children):
+    payload = b"".join(children)
+    return struct.pack(">I4s", 8 + len(payload), box_type.encode("latin-1")) + payload
+
+
+def box64(box_type, *children):
+    payload = b"".join(children)
+    return struct.pack(">I4sQ", 1, box_type.encode("latin-1"), 16 + len(payload)) + payload
+
+
+def full(version, *fields):
+    return bytes([version, 0, 0, 0]) + b"".join(fields)
+
+
+MATRIX_90 = struct.pack(">9i", 0, 0x10000, 0, -0x10000, 0, 0, 0, 0, 0x40000000)
+MATRIX_0 = struct.pack(">9i", 0x10000, 0, 0, 0, 0x10000, 0, 0, 0, 0x40000000)
+
+
+def tkhd(version=0, matrix=MATRIX_0):
+    if version == 1:
+        times = struct.pack(">QQIIQ", 0, 0, 1, 0, 0)
+    else:
+        times = struct.pack(">IIIII", 0, 0, 1, 0, 0)
+    return box("tkhd", full(version, times, bytes(16), matrix, struct.pack(">II", 0, 0)))
+
+
+def mdhd(timescale, duration, version=0):
+    if version == 1:
+        fields = struct.pack(">QQIQ", 0, 0, timescale, duration)
+    else:
+        fields = struct.pack(">IIII", 0, 0, timescale, duration)
+    return box("mdhd", full(version, fields, bytes(4)))
+
+
+def avcc(profile=100, chroma=1, depth=8):
+    sps = bytes([0x67, profile, 0, 30])
+    pps = bytes([0x68, 0xEE])
+    return box("avcC", bytes([1, profile, 0, 30, 0xFF, 0xE1]),
+               struct.pack(">H", len(sps)), sps, bytes([1]), struct.pack(">H", len(pps)), pps,
+               bytes([0xFC | chroma, 0xF8 | (depth - 8), 0xF8 | (depth - 8), 0]))
+
+
+def video_trak(width=640, height=360, samples=50, delta=512, timescale=12800, keyframes=(1, 26),
+               tkhd_box=None, mdhd_version=0, config=None):
+    entry = box("avc1", bytes(6), struct.pack(">H", 1), bytes(16), struct.pack(">HH", width, height),
+                bytes(50), config if config is not None else avcc())
+    tables = [
+        box("stsd", full(0, struct.pack(">I", 1)), entry),
+        box("stts", full(0, struct.pack(">I", 1 if samples else 0)),
+            struct.pack(">II", samples, delta) if samples else b""),
+    ]
+    if keyframes is not None:
+        tables.append(box("stss", full(0, struct.pack(">I", len(keyframes)), *(struct.pack(">I", n) for n in keyframes))))
+    return box(
+        "trak",
+        tkhd_box if tkhd_box is not None else tkhd(),
+        box("mdia",
+            mdhd(timescale, samples * delta, mdhd_version),
+            box("hdlr", full(0, bytes(4), b"vide", bytes(12))),
+            box("minf", box("stbl", *tables))),
+    )
+
+
+def audio_trak():
+    entry = box("mp4a", bytes(6), struct.pack(">H", 1), bytes(8), struct.pack(">HHHH", 2, 16, 0, 0),
+                struct.pack(">I", 48000 << 16))
+    return box(
+        "trak",
+        tkhd(),
+        box("mdia",
+            mdhd(48000, 96000),
+            box("hdlr", full(0, bytes(4), b"soun", bytes(12))),
+            box("minf", box("stbl", box("stsd", full(0, struct.pack(">I", 1)), entry)))),
+    )
+
+
+def moov(*traks, timescale=1000, duration=2000):
+    return box("moov", box("mvhd", full(0, struct.pack(">IIII", 0, 0, timescale, duration), bytes(80))), *traks)
+
+
+FTYP = box("ftyp", b"isom", bytes(4), b"isomavc1")
+MDAT = box("mdat", bytes(4000))
+
+
+class Mp4ParserTest(unittest.TestCase):
+    """probe_mp4() and mp4_keyframes() over small synthetic files."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, *boxes):
+        path = os.path.join(self.tmp.name, f"clip{len(os.listdir(self.tmp.name))}.mp4")
+        with open(path, "wb") as f:
+            f.write(b"".join(boxes))
+        return path
+
+    def test_moov_first(self):
+        probe = conformvids.probe_mp4(self.write(FTYP, moov(video_trak(), audio_trak()), MDAT))
+        self.assertEqual((probe.width, probe.height, probe.codec, probe.pix_fmt), (640, 360, "h264", "yuv420p"))
+        self.assertAlmostEqual(probe.duration, 2.0)
+        self.assertAlmostEqual(probe.fps, 25.0)
+        self.assertEqual(probe.audio_streams, [{"index": 1, "codec": "aac", "channels": 2, "sample_rate": 48000}])
+
+    def test_moov_at_end_after_64_bit_mdat(self):
+        path = self.write(FTYP, box64("mdat", bytes(4000)), moov(video_trak()))
+        self.assertEqual(conformvids.probe_mp4(path).width, 640)
+
+    def test_size_zero_box_runs_to_end_of_file(self):
+        top = moov(video_trak())
+        path = self.write(FTYP, MDAT, struct.pack(">I", 0) + top[4:])
+        self.assertEqual(conformvids.probe_mp4(path).height, 360)
+        data = box("free", bytes(4)) + struct.pack(">I4s", 0, b"skip") + bytes(12)
+        self.assertEqual([(t, e - s) for t, s, e in conformvids.iter_boxes(data)], [("free", 4), ("skip", 12)])
+
+    def test_tkhd_rotation_v0_and_v1(self):
+        for version in (0, 1):
+            with self.subTest(version=version):
+                trak = video_trak(tkhd_box=tkhd(version, MATRIX_90))
+                self.assertEqual(conformvids.probe_mp4(self.write(FTYP, moov(trak), MDAT)).rotation, -90)
+                trak = video_trak(tkhd_box=tkhd(version, MATRIX_0))
+                self.assertEqual(conformvids.probe_mp4(self.write(FTYP, moov(trak), MDAT)).rotation, 0)
+
+    def test_mdhd_v0_and_v1(self):
+        for version in (0, 1):
+            with self.subTest(version=version):
+                trak = video_trak(samples=90, delta=1001, timescale=30000, mdhd_version=version)
+                probe = conformvids.probe_mp4(self.write(FTYP, moov(trak), MDAT))
+                self.assertAlmostEqual(probe.duration, 90 * 1001 / 30000)
+                self.assertAlmostEqual(probe.fps, 30000 / 1001)
+
+    def test_fragmented_file_is_refused(self):
+        trak = video_trak(samples=0)
+        path = self.write(FTYP, moov(trak, box("mvex", box("trex", full(0, bytes(20))))),
+                          box("moof", box("mfhd", full(0, bytes(4)))), MDAT)
+        with self.assertRaises(conformvids.Mp4ParseError):
+            conformvids.probe_mp4(path)
+        with self.assertRaises(conformvids.Mp4ParseError):
+            conformvids.mp4_keyframes(path)
+
+    def test_keyframes_from_stss(self):
+        path = self.write(FTYP, moov(video_trak()), MDAT)
+        self.assertEqual(conformvids.mp4_keyframes(path), [0.0, 1.0])
+        path = self.write(FTYP, moov(video_trak(samples=3, keyframes=None)), MDAT)
+        self.assertEqual(conformvids.mp4_keyframes(path), [0.0, 0.04, 0.08])
+
+    def test_pix_fmt_from_codec_configuration(self):
+        cases = [
+            (avcc(profile=66), "yuv420p"),
+            (avcc(profile=110, chroma=2, depth=10), "yuv422p10le"),
+            (avcc(profile=244, chroma=3), "yuv444p"),
+            (box("hvcC", bytes([1, 2]), bytes(14), bytes([0xFD, 0xFA]), bytes(5)), "yuv420p10le"),
+            (box("vpcC", full(1, bytes([0, 10, 0x84]))), "yuv422p"),
+            (box("av1C", bytes([0x81, 0x08, 0x0C, 0])), "yuv420p"),
+            (b"", None),
+        ]
+        for config, expected in cases:
+            with self.subTest(expected=expected):
+                path = self.write(FTYP, moov(video_trak(config=config)), MDAT)
+                self.assertEqual(conformvids.probe_mp4(path).pix_fmt, expected)
+
+    def test_malformed_boxes_fall_back_to_ffprobe(self):
+        empty_tkhd_last = box("trak", box("mdia"), box("tkhd"))
+        truncated_stts = video_trak()[:-40]
+        truncated_stts = struct.pack(">I", len(truncated_stts)) + truncated_stts[4:]
+        saved = conformvids.ffprobe_video
+        conformvids.ffprobe_video = lambda path: "ffprobe"
+        try:
+            for trak in (empty_tkhd_last, truncated_stts):
+                path = self.write(FTYP, moov(trak), MDAT)
+                with self.assertRaises(conformvids.MP4_ERRORS):
+                    conformvids.probe_mp4(path)
+                self.assertEqual(conformvids.probe_video(path, engine="auto"), "ffprobe")
+        finally:
+            conformvids.ffprobe_video = saved
+
+
+if __name__ == "__main__":
+    unittest.main()